@@ -0,0 +1,46 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Encodings for the choices and clocks fields of a rating stored in Redis.
+# merge.lua writes them; the codecs here only read them back.
+
+# Core libraries
+import ast
+import json
+
+# Optional library, needed only for the msgpack codec
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Names of the codecs merge.lua can write
+codecs = ('json', 'msgpack')
+
+def check_codec(name):
+    """ Return name if it is a codec whose values can be read back here. """
+    if name not in codecs:
+        raise Exception('Unknown value codec %s' % name)
+    if name == 'msgpack' and msgpack is None:
+        raise Exception('The msgpack codec needs the msgpack library (pip install msgpack)')
+    return name
+
+def decode(data):
+    """ Decode a stored value, whichever codec wrote it.
+
+        JSON values are lists, so they start with '['; anything else is
+        msgpack. Values written before codecs were introduced were Python
+        list literals, which are read as JSON when they are valid JSON and
+        as Python literals otherwise.
+    """
+    if data[:1] != '[':
+        if msgpack is None:
+            raise Exception('Value is msgpack encoded but the msgpack library is not installed')
+        return msgpack.unpackb(data, raw=False)
+    try:
+        return json.loads(data)
+    except ValueError:
+        return ast.literal_eval(data)
+
+def decode_clocks(data):
+    """ Decode a stored clock list to a list of dicts. """
+    # msgpack cannot tell an empty clock from an empty list
+    return [vc if vc != [] else {} for vc in decode(data)]
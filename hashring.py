@@ -0,0 +1,143 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Mapping of entities to the DB instance (shard) that is their primary
+
+# Core libraries
+import zlib
+import bisect
+import struct
+import hashlib
+import binascii
+
+# Non-cryptographic hashes, much cheaper than any in hashlib
+fast_hashes = { 'crc32': lambda s: zlib.crc32(s) & 0xffffffff,
+                'adler32': lambda s: zlib.adler32(s) & 0xffffffff }
+
+digest_structs = {} # digest size => Struct splitting it into integers
+
+def digest_to_long(digest):
+    """ Read a digest as one big-endian integer, the same value as
+        long(hexdigest, 16) but without building the hex string.
+    """
+    size = len(digest)
+    if size not in digest_structs:
+        if size % 8 == 0:
+            digest_structs[size] = struct.Struct('>' + 'Q' * (size // 8))
+        elif size % 8 == 4:
+            digest_structs[size] = struct.Struct('>I' + 'Q' * (size // 8))
+        else:
+            digest_structs[size] = None
+    unpacker = digest_structs[size]
+    if unpacker is None:
+        return long(binascii.hexlify(digest), 16)
+    parts = unpacker.unpack(digest)
+    value = parts[0]
+    for part in parts[1:]:
+        value = (value << 64) | part
+    return value
+
+def entity_hash(entity, algorithm='sha1'):
+    """ Hash a string to a non-negative integer.
+        algorithm is any hashlib algorithm, or one of fast_hashes.
+    """
+    if algorithm in fast_hashes:
+        return fast_hashes[algorithm](entity)
+    constructor = getattr(hashlib, algorithm, None)
+    if constructor is not None:
+        return digest_to_long(constructor(entity).digest())
+    h = hashlib.new(algorithm)
+    h.update(entity)
+    return digest_to_long(h.digest())
+
+def modulo_shard(entity, ndb, algorithm='sha1'):
+    """ The original scheme: hash modulo the number of DBs.
+        Changing ndb moves almost every entity to a different shard.
+    """
+    return int(entity_hash(entity, algorithm) % ndb)
+
+class HashRing(object):
+    """ Consistent-hash ring with vnodes tokens per DB.
+
+        Each DB owns the arcs of the ring ending at its tokens, and an
+        entity belongs to the owner of the first token at or after its
+        hash. Adding or removing a DB only moves the entities on the arcs
+        that DB gains or loses, about 1/ndb of them.
+    """
+    def __init__(self, ndb, vnodes=100, algorithm='sha1'):
+        self.ndb = ndb
+        self.vnodes = vnodes
+        self.algorithm = algorithm
+        points = sorted((entity_hash('db%d#%d' % (db, v), algorithm), db)
+                        for db in range(ndb) for v in range(vnodes))
+        self.tokens = [token for token, db in points]
+        self.owners = [db for token, db in points]
+
+    def shard(self, entity):
+        i = bisect.bisect_left(self.tokens, entity_hash(entity, self.algorithm))
+        if i == len(self.tokens):
+            i = 0 # wrap around the ring
+        return self.owners[i]
+
+def make_sharder(scheme, ndb, vnodes=100, algorithm='sha1'):
+    """ Return a function mapping an entity to its shard in [0, ndb).
+        scheme is 'modulo' or 'ring'.
+    """
+    if scheme == 'modulo':
+        return lambda entity: modulo_shard(entity, ndb, algorithm)
+    elif scheme == 'ring':
+        return HashRing(ndb, vnodes, algorithm).shard
+    raise Exception('Unknown sharding scheme %s' % scheme)
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class HashRingTestCase(unittest.TestCase):
+    """Test hashing, and how many entities move when the number of DBs changes"""
+    entities = ['entity-%d' % i for i in range(5000)]
+
+    def moved(self, scheme, before, after):
+        old = make_sharder(scheme, before)
+        new = make_sharder(scheme, after)
+        return [e for e in self.entities if old(e) != new(e)], old, new
+
+    def testDigestToLong(self):
+        for algorithm in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'):
+            h = hashlib.new(algorithm, 'bob')
+            self.assertEquals(digest_to_long(h.digest()), long(h.hexdigest(), 16))
+        self.assertEquals(digest_to_long('\x01\x02\x03'), 0x010203)
+
+    def testShardRange(self):
+        for scheme in ('modulo', 'ring'):
+            shard = make_sharder(scheme, 4)
+            shards = set(shard(e) for e in self.entities)
+            self.assertEquals(shards, set(range(4)))
+        self.assertRaises(Exception, make_sharder, 'random', 4)
+
+    def testRingAddMovesFew(self):
+        # A fifth DB should take about 1/5 of the entities, and only those
+        moved, old, new = self.moved('ring', 4, 5)
+        fraction = float(len(moved)) / len(self.entities)
+        self.assertTrue(0.1 < fraction < 0.3, fraction)
+        for e in moved:
+            self.assertEquals(new(e), 4)
+
+    def testRingRemoveMovesFew(self):
+        # Only the entities of the removed DB move
+        moved, old, new = self.moved('ring', 5, 4)
+        self.assertEquals(set(moved), set(e for e in self.entities if old(e) == 4))
+        fraction = float(len(moved)) / len(self.entities)
+        self.assertTrue(0.1 < fraction < 0.3, fraction)
+
+    def testModuloMovesMost(self):
+        moved, old, new = self.moved('modulo', 4, 5)
+        self.assertTrue(float(len(moved)) / len(self.entities) > 0.7)
+
+    def testFastHashes(self):
+        for algorithm in fast_hashes:
+            value = entity_hash('bob', algorithm)
+            self.assertTrue(0 <= value < 1 << 32)
+            self.assertEquals(HashRing(3, 10, algorithm).shard('bob'), HashRing(3, 10, algorithm).shard('bob'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Keep-alive HTTP client shared by the servers for calls to other local services
+
+# Core libraries
+import threading
+
+# Libraries that must be installed via pip
+import requests
+from requests.adapters import HTTPAdapter
+
+class PooledClient(object):
+    """ HTTP client that keeps a pool of open connections to each upstream port.
+
+        pool_size is the number of connections kept per port; pool_sizes
+        optionally maps a port (as an int or string) to its own pool size.
+    """
+    def __init__(self, pool_size=1, pool_sizes=None, host='localhost'):
+        self.host = host
+        self.pool_size = pool_size
+        self.pool_sizes = dict((int(p), n) for p, n in (pool_sizes or {}).items())
+        self.session = requests.Session()
+        self.adapters = {} # port => HTTPAdapter
+        self.lock = threading.Lock()
+
+    def url(self, port, path):
+        return 'http://'+self.host+':'+str(port)+path
+
+    def request(self, method, port, path, **kwargs):
+        self._mount(port)
+        return self.session.request(method, self.url(port, path), **kwargs)
+
+    def get(self, port, path, **kwargs):
+        return self.request('GET', port, path, **kwargs)
+
+    def put(self, port, path, **kwargs):
+        return self.request('PUT', port, path, **kwargs)
+
+    def delete(self, port, path, **kwargs):
+        return self.request('DELETE', port, path, **kwargs)
+
+    def stats(self):
+        """ Return { port: { size, hits, misses } } for every port used so far.
+            A miss is a request that had to open a new connection; a hit
+            reused one already in the pool.
+        """
+        stats = {}
+        for port, adapter in self.adapters.items():
+            pool = adapter.poolmanager.connection_from_host(self.host, port, scheme='http')
+            stats[port] = {'size': self.pool_sizes.get(port, self.pool_size),
+                           'hits': pool.num_requests - pool.num_connections,
+                           'misses': pool.num_connections}
+        return stats
+
+    def _mount(self, port):
+        if port in self.adapters:
+            return
+        with self.lock:
+            if port not in self.adapters:
+                size = self.pool_sizes.get(port, self.pool_size)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                self.session.mount(self.url(port, '/'), adapter)
+                self.adapters[port] = adapter
@@ -0,0 +1,137 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Bounded least-recently-used cache
+
+# Core libraries
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ Map of at most maxsize entries; adding to a full cache evicts the
+        entry that was least recently read or written. If ttl is given,
+        an entry also expires ttl seconds after it was written.
+
+        epoch counts the invalidations so far. A caller that reads a
+        value from elsewhere to cache it can take the epoch first and
+        pass it to put, which then drops the value if anything was
+        invalidated in between, as it may have been read before the change.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key => (value, expiry), oldest first
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, expiry = self.entries.pop(key)
+            if expiry is not None and expiry <= time.time():
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries[key] = (value, expiry)
+            return value
+
+    def put(self, key, value, epoch=None):
+        if self.maxsize <= 0:
+            return
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.maxsize:
+                self.entries.popitem(last=False)
+            self.entries[key] = (value, expiry)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.epoch += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """ Return { size, maxsize, hits, misses, hit-ratio }. """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit-ratio': float(self.hits) / lookups if lookups else 0.0}
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Test eviction, expiry and invalidation of the cache"""
+
+    def testEviction(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(len(cache), 2)
+
+    def testDisabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertEquals(cache.get('a', 'missing'), 'missing')
+
+    def testExpiry(self):
+        cache = LRUCache(2, ttl=0.05)
+        cache.put('a', 1)
+        self.assertEquals(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.stats()['misses'], 1)
+        cache.put('a', 2)
+        self.assertEquals(cache.get('a'), 2)
+
+    def testInvalidationRace(self):
+        cache = LRUCache(2)
+        cache.put('a', 'old')
+        # A reader takes the epoch, and the key changes before it puts
+        epoch = cache.epoch
+        cache.invalidate('a')
+        cache.put('a', 'stale', epoch)
+        self.assertEquals(cache.get('a'), None)
+        # Any invalidation in between counts, even of another key
+        epoch = cache.epoch
+        cache.invalidate('b')
+        cache.put('a', 'stale', epoch)
+        self.assertEquals(cache.get('a'), None)
+        epoch = cache.epoch
+        cache.put('a', 'fresh', epoch)
+        self.assertEquals(cache.get('a'), 'fresh')
+
+    def testClear(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        epoch = cache.epoch
+        cache.clear()
+        cache.put('b', 2, epoch)
+        self.assertEquals(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
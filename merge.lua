@@ -0,0 +1,148 @@
+-- Atomic read-compare-write of one rating, run inside Redis by serverDB.merge
+--
+-- KEYS[1]  key for the tea
+-- ARGV[1]  new rating
+-- ARGV[2]  clock of the new rating, as a JSON object
+-- ARGV[3]  codec for the stored choices and clocks, 'json' or 'msgpack'
+--
+-- Returns { written (1 or 0), rating, choices, clocks } where choices and
+-- clocks are the encoded lists now stored for the key, or empty strings
+-- if the new clock was not newer than every stored clock.
+-- Stored values are read whichever codec wrote them (see codec.py).
+--
+-- The key also holds the sum and count of its choices, so a reader can
+-- get the mean without decoding them. The sum is taken afresh over the
+-- surviving choices on every merge, in the pass that compares the clocks,
+-- so that no rounding error is carried from one merge to the next.
+
+-- Format x as Python's repr of a float does: the fewest digits that read
+-- back as x, and always a decimal point or exponent, so 5 is '5.0'
+local function num(x)
+    local s
+    for digits = 15, 17 do
+        s = string.format('%.' .. digits .. 'g', x)
+        if tonumber(s) == x then
+            break
+        end
+    end
+    if not string.find(s, '[.eni]') then
+        s = s .. '.0'
+    end
+    return s
+end
+
+-- JSON lists start with '['; anything else is msgpack
+local function decode(data)
+    if string.sub(data, 1, 1) == '[' then
+        return cjson.decode(data)
+    end
+    return cmsgpack.unpack(data)
+end
+
+local function encode_choices(choices)
+    if ARGV[3] == 'msgpack' then
+        return cmsgpack.pack(choices)
+    end
+    -- cjson rounds numbers to 14 digits, so format them ourselves
+    local parts = {}
+    for i, choice in ipairs(choices) do
+        parts[i] = num(choice)
+    end
+    return '[' .. table.concat(parts, ',') .. ']'
+end
+
+local function encode_clocks(clocks)
+    if ARGV[3] == 'msgpack' then
+        return cmsgpack.pack(clocks)
+    end
+    return cjson.encode(clocks)
+end
+
+-- Compare clock a with clock b in one pass, as VectorClock.compare does.
+-- Returns 'BEFORE', 'AFTER', 'EQUAL' or 'CONCURRENT'.
+local function compare(a, b)
+    local le, ge = true, true
+    local shared = 0
+    for node, count in pairs(a) do
+        local other = b[node]
+        if other == nil then
+            le = false
+        else
+            shared = shared + 1
+            if count < other then
+                ge = false
+            elseif count > other then
+                le = false
+            end
+        end
+        if not (le or ge) then
+            return 'CONCURRENT'
+        end
+    end
+    if ge then
+        for node in pairs(b) do
+            shared = shared - 1
+        end
+        if shared < 0 then
+            ge = false
+        end
+    end
+    if le then
+        return ge and 'EQUAL' or 'BEFORE'
+    end
+    return ge and 'AFTER' or 'CONCURRENT'
+end
+
+local key = KEYS[1]
+local setrating = tonumber(ARGV[1])
+local setclock = cjson.decode(ARGV[2])
+
+local stored = redis.call('HMGET', key, 'rating', 'choices', 'clocks')
+local choices = {}
+local vcl = {}
+if stored[1] then
+    choices = decode(stored[2])
+    vcl = decode(stored[3])
+end
+
+-- The sum is added up in list order, as the Python merge did
+local new_choices = {}
+local new_vcl = {}
+local sum = 0
+local replaced = false
+for i, old_clock in ipairs(vcl) do
+    local order = compare(setclock, old_clock)
+    -- if the received clock is older, nothing needs updating
+    if order == 'BEFORE' or order == 'EQUAL' then
+        return { 0, stored[1], '', '' }
+    end
+    if order == 'AFTER' then
+        -- the received clock is newer; it takes the place of the first
+        -- clock it supersedes and drops the rest
+        if not replaced then
+            replaced = true
+            table.insert(new_vcl, setclock)
+            table.insert(new_choices, setrating)
+            sum = sum + setrating
+        end
+    else
+        -- incomparable
+        table.insert(new_vcl, old_clock)
+        table.insert(new_choices, choices[i])
+        sum = sum + choices[i]
+    end
+end
+if not replaced then
+    table.insert(new_vcl, setclock)
+    table.insert(new_choices, setrating)
+    sum = sum + setrating
+end
+local count = #new_choices
+
+local rating = num(sum / count)
+local choices_data = encode_choices(new_choices)
+local clocks_data = encode_clocks(new_vcl)
+
+redis.call('HMSET', key, 'rating', rating, 'choices', choices_data, 'clocks', clocks_data,
+           'sum', num(sum), 'count', count)
+return { 1, rating, choices_data, clocks_data }
@@ -4,42 +4,108 @@
 # Core libraries
 import json
 
-# Libraries that must be installed via pip
-import requests
-
 # Libraries provided with assignment
-from vectorclock import VectorClock
+from httppool import PooledClient
+from vectorclock import VectorClock, CompactVectorClock
 
 # Distinguished label to indicate a clock list
 CLOCK_CODE = 'CLOCK_LIST_XXX'
 
 class Queue(object):
-    def __init__(self, port):
+    def __init__(self, port, pool_size=1):
         self.port = port
+        self.client = PooledClient(pool_size)
+        self.lengths = {} # channel => length reported by the last GET
+
+    def pool_stats(self):
+        """ Connection reuse counters for the queue server's port. """
+        return self.client.stats().get(self.port, {'size': self.client.pool_size, 'hits': 0, 'misses': 0})
+
+    def backlog(self, channel):
+        """ Messages left in channel after our last GET from it. """
+        return self.lengths.get(channel, 0)
 
-    def get(self, channel):
-        resp = requests.get('http://localhost:'+str(self.port)+'/q/'+channel,
-                            headers={'content-type': 'application/json'})
+    def get(self, channel, wait=None):
+        """ Pop the next message from channel, or return None if it is empty.
+            If wait is given, block for up to that many seconds for a
+            message to arrive instead of returning None straight away.
+        """
+        resp = self.client.get(self.port, '/q/'+channel,
+                               params=self._wait_params(wait),
+                               timeout=self._timeout(wait),
+                               headers={'content-type': 'application/json'})
+        self._record_length(channel, resp)
         jresp = resp.json()
         if len(jresp) > 0:
-            for k in jresp:
-                if (isinstance(jresp[k],dict) and
-                    jresp[k].keys() == [CLOCK_CODE]):
-                    jresp[k] = [VectorClock.fromDict(dc) for dc in jresp[k][CLOCK_CODE]]
-            return jresp
+            return self._decode(jresp)
         else:
             return None
+
+    def get_many(self, channel, max_items=None, wait=None):
+        """ Pop up to max_items messages from channel in one request.
+            If max_items is None the whole channel is drained.
+            If wait is given and the channel is empty, block for up to
+            that many seconds for a message to arrive.
+            Returns a (possibly empty) list of messages, oldest first.
+        """
+        params = self._wait_params(wait)
+        if max_items is not None:
+            params['max'] = max_items
+        resp = self.client.get(self.port, '/q/'+channel+'/batch',
+                               params=params,
+                               timeout=self._timeout(wait),
+                               headers={'content-type': 'application/json'})
+        self._record_length(channel, resp)
+        return [self._decode(msg) for msg in resp.json()]
+
+    def _wait_params(self, wait):
+        if wait is None:
+            return {}
+        return {'wait': wait}
+
+    def _timeout(self, wait):
+        """ Allow a blocking GET its full wait before the request times out. """
+        if wait is None:
+            return None
+        return wait + 10
+
+    def _record_length(self, channel, resp):
+        if 'X-Queue-Length' in resp.headers:
+            self.lengths[channel] = int(resp.headers['X-Queue-Length'])
+
+    def _decode(self, msg):
+        """ Turn the encoded clock lists in a received message back into VectorClocks. """
+        for k in msg:
+            if (isinstance(msg[k],dict) and
+                msg[k].keys() == [CLOCK_CODE]):
+                msg[k] = [CompactVectorClock.fromDict(dc) for dc in msg[k][CLOCK_CODE]]
+        return msg
             
     def put(self, channel, dct):
+        res = self.client.put(self.port, '/q/'+channel,
+                               data=json.dumps(self._encode(dct)),
+                               headers={'content-type': 'application/json'})
+
+    def put_many(self, channel, dcts):
+        """ Append every message in dcts to channel in one request.
+            Raises if the queue server does not accept them.
+        """
+        if len(dcts) == 0:
+            return
+        res = self.client.put(self.port, '/q/'+channel+'/batch',
+                               data=json.dumps([self._encode(dct) for dct in dcts]),
+                               headers={'content-type': 'application/json'})
+        res.raise_for_status()
+
+    def _encode(self, dct):
+        """ Replace the VectorClock lists in a message with a JSON-friendly form. """
         if not isinstance(dct, dict):
             raise Exception('Message to send is not a dict')
             
         for k in dct:
             if (isinstance(dct[k],(list, tuple)) and
-                isinstance(dct[k][0], VectorClock)):
+                len(dct[k]) > 0 and
+                isinstance(dct[k][0], (VectorClock, CompactVectorClock))):
                 dct[k] = {CLOCK_CODE: [vc.asDict() for vc in dct[k]]}
-        
-        res = requests.put('http://localhost:'+str(self.port)+'/q/'+channel,
-                            data=json.dumps(dct),
-                            headers={'content-type': 'application/json'})
+        return dct
                                
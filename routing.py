@@ -0,0 +1,172 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Load-aware choice of DB instance for reads that any instance may serve
+
+# Core libraries
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+class DBLoad(object):
+    """ Live load of one DB instance as seen by this load balancer. """
+    def __init__(self):
+        self.inflight = 0   # requests sent and not yet answered
+        self.ewma = None    # moving average of latency, in seconds
+        self.requests = 0
+        self.errors = 0
+        self.failed_at = None # time of the latest error, if any
+
+class Request(object):
+    """ One request tracked by Router.track. """
+    def __init__(self):
+        self.failed = False # set if the reply was an error
+
+class Router(object):
+    """ Track the latency and concurrency of every DB instance, and pick
+        one to serve a read according to policy:
+
+        random             uniformly at random, as the assignment specifies
+        p2c                the less busy of two picked at random
+        least-outstanding  the one with fewest requests in flight
+        ewma               the lowest average latency, scaled by the
+                           number of requests in flight
+
+        alpha is the weight of the newest sample in the latency average.
+        Except under random, an instance whose latest error was less than
+        cooldown seconds ago is only picked if every other one has one too,
+        since a dead instance fails fast and would otherwise look idle.
+    """
+    policies = ('random', 'p2c', 'least-outstanding', 'ewma')
+
+    def __init__(self, policy='random', alpha=0.3, cooldown=1.0):
+        if policy not in self.policies:
+            raise Exception('Unknown read routing policy %s' % policy)
+        self.policy = policy
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.loads = {} # shard => DBLoad
+        self.lock = threading.Lock()
+
+    def choose(self, shards):
+        """ Pick one of the list shards to send a read to. """
+        if self.policy == 'random' or len(shards) == 1:
+            return random.choice(shards)
+        if self.policy == 'p2c':
+            a, b = random.sample(shards, 2)
+            return min((a, b), key=self._busyness)
+        # Break ties at random so idle instances share the work
+        shards = random.sample(shards, len(shards))
+        if self.policy == 'least-outstanding':
+            return min(shards, key=lambda shard: (self._failing(shard), self._load(shard).inflight))
+        return min(shards, key=self._cost)
+
+    @contextmanager
+    def track(self, shard):
+        """ Count a request to shard as in flight for the duration of the
+            with block, and record its latency unless it raises or marks
+            the Request it is given as failed, in which case record an error.
+        """
+        load = self._load(shard)
+        with self.lock:
+            load.inflight += 1
+            load.requests += 1
+        start = time.time()
+        request = Request()
+        try:
+            yield request
+        except Exception:
+            self._fail(load)
+            raise
+        else:
+            latency = time.time() - start
+            if request.failed:
+                self._fail(load)
+            else:
+                with self.lock:
+                    if load.ewma is None:
+                        load.ewma = latency
+                    else:
+                        load.ewma += self.alpha * (latency - load.ewma)
+        finally:
+            with self.lock:
+                load.inflight -= 1
+
+    def stats(self):
+        """ Return { policy, shards: { shard: { inflight, latency, requests, errors } } }. """
+        with self.lock:
+            return {'policy': self.policy,
+                    'shards': dict((shard, {'inflight': load.inflight,
+                                            'latency': load.ewma,
+                                            'requests': load.requests,
+                                            'errors': load.errors})
+                                   for shard, load in self.loads.items())}
+
+    def _load(self, shard):
+        if shard not in self.loads:
+            with self.lock:
+                self.loads.setdefault(shard, DBLoad())
+        return self.loads[shard]
+
+    def _fail(self, load):
+        with self.lock:
+            load.errors += 1
+            load.failed_at = time.time()
+
+    def _failing(self, shard):
+        failed_at = self._load(shard).failed_at
+        return failed_at is not None and time.time() - failed_at < self.cooldown
+
+    def _busyness(self, shard):
+        load = self._load(shard)
+        return (self._failing(shard), load.inflight, load.ewma or 0.0)
+
+    def _cost(self, shard):
+        # An instance that has never answered is tried before any other
+        # that has not failed lately
+        load = self._load(shard)
+        return (self._failing(shard), (load.ewma or 0.0) * (load.inflight + 1))
+
+class ShardLimiter(object):
+    """ Bound the number of requests in flight to each DB instance.
+
+        A request over the limit waits for one of the others to finish,
+        for at most timeout seconds. With a limit of None nothing waits.
+    """
+    def __init__(self, limit=None, timeout=5.0):
+        self.limit = limit
+        self.timeout = timeout
+        self.inflight = {} # shard => requests in flight
+        self.rejected = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, shard):
+        """ Hold one of shard's slots for the duration of the with block.
+            Raises ShardBusy if none frees up in time.
+        """
+        if self.limit is None:
+            yield
+            return
+        with self.cond:
+            deadline = time.time() + self.timeout
+            while self.inflight.get(shard, 0) >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise ShardBusy(shard)
+                self.cond.wait(remaining)
+            self.inflight[shard] = self.inflight.get(shard, 0) + 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.inflight[shard] -= 1
+                self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {'limit': self.limit, 'rejected': self.rejected}
+
+class ShardBusy(Exception):
+    """ A DB instance already has as many requests in flight as allowed. """
+    pass
@@ -0,0 +1,433 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Durable append-only log of the messages in each serverQ channel
+
+# Core libraries
+import os
+import mmap
+import time
+import struct
+import urllib
+import threading
+import traceback
+
+# A record is the length of its message, as a 4-byte big-endian integer,
+# followed by the message
+record_header = struct.Struct('>I')
+
+# Name of the file holding the number of the first unconsumed record
+CURSOR = 'consumed'
+
+class Segment(object):
+    """ One file of a channel's log, whose records are numbered from first. """
+    def __init__(self, path, first):
+        self.path = path
+        self.first = first
+
+class ChannelLog(object):
+    """ The segments of one channel, oldest first. Records are numbered
+        from 0 in the order they were appended; head is the number of the
+        next one and consumed the number of the first not yet consumed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.head = 0
+        self.consumed = 0
+        self.saved = 0      # value of consumed last written to disk
+        self.file = None    # the last segment, open for appending
+        self.size = 0       # bytes in the last segment
+        self.dirty = False  # records written since the last fsync
+        self.rolled = []    # descriptors of closed segments not yet synced
+
+class SegmentLog(object):
+    """ Append-only log of every channel under directory, one
+        subdirectory per channel, split into segment files of about
+        segment_size bytes.
+
+        A thread fsyncs the log as soon as there is anything new to write,
+        at most once every sync_interval seconds, so the appends made
+        while one fsync runs all share the next. With sync 'group', wait
+        returns once a given append is on disk; with 'async', it returns
+        at once, and the last appends may be lost in a crash.
+
+        Consumption is recorded as a cursor per channel, written by the
+        same thread, and segments entirely before the cursor are deleted.
+        A message consumed just before a crash may be replayed after it.
+
+        If a sync fails, every append it covered fails in wait, and the
+        thread tries again after retry_delay seconds.
+    """
+    retry_delay = 1.0
+
+    def __init__(self, directory, segment_size=4 << 20, sync='group', sync_interval=0.0):
+        if sync not in ('group', 'async'):
+            raise Exception('Unknown log sync mode %s' % sync)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.channels = {} # channel => ChannelLog
+        self.lock = threading.Condition()
+        self.written = 0   # appends so far
+        self.synced = 0    # appends known to be on disk
+        self.failed = 0    # appends whose sync raised an error
+        self.fsyncs = 0
+        self.compacted = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def replay(self):
+        """ Read back the log and start syncing it. Returns { channel:
+            [message, ...] } of the unconsumed messages, oldest first.
+            Call once, before any other method.
+        """
+        messages = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('q-'):
+                channel = urllib.unquote(name[2:])
+                messages[channel] = self._replay_channel(channel)
+        syncer = threading.Thread(target=self._sync_forever)
+        syncer.daemon = True
+        syncer.start()
+        return messages
+
+    def append(self, channel, msgs):
+        """ Append every message in msgs to channel. Returns a ticket to wait on. """
+        if not msgs:
+            return 0
+        with self.lock:
+            log = self._channel(channel)
+            for msg in msgs:
+                if log.file is None or log.size >= self.segment_size:
+                    self._roll(log)
+                log.file.write(record_header.pack(len(msg)))
+                log.file.write(msg)
+                log.size += record_header.size + len(msg)
+                log.head += 1
+            log.dirty = True
+            self.written += 1
+            self.lock.notify_all()
+            return self.written
+
+    def wait(self, ticket):
+        """ Block until the append that returned ticket is on disk, unless
+            the log syncs asynchronously. Raises IOError if it could not be synced.
+        """
+        if self.sync == 'async':
+            return
+        with self.lock:
+            while self.synced < ticket:
+                if ticket <= self.failed:
+                    raise IOError('Queue log sync failed')
+                self.lock.wait()
+
+    def consume(self, channel, count):
+        """ Record that the next count messages of channel were taken. """
+        with self.lock:
+            self._channel(channel).consumed += count
+            self.lock.notify_all()
+
+    def clear(self):
+        """ Delete every channel. """
+        with self.lock:
+            for log in self.channels.values():
+                if log.file is not None:
+                    log.file.close()
+                for fd in log.rolled:
+                    os.close(fd)
+                for segment in log.segments:
+                    os.remove(segment.path)
+                if os.path.exists(os.path.join(log.directory, CURSOR)):
+                    os.remove(os.path.join(log.directory, CURSOR))
+                os.rmdir(log.directory)
+            self.channels = {}
+            self.synced = self.written
+            self.lock.notify_all()
+
+    def stats(self):
+        """ Return { segments, appends, fsyncs, appends-per-fsync, compacted }. """
+        with self.lock:
+            return {'segments': sum(len(log.segments) for log in self.channels.values()),
+                    'appends': self.written,
+                    'fsyncs': self.fsyncs,
+                    'appends-per-fsync': float(self.written) / self.fsyncs if self.fsyncs else 0.0,
+                    'compacted': self.compacted}
+
+    def _channel(self, channel):
+        if channel not in self.channels:
+            log = ChannelLog(os.path.join(self.directory, 'q-' + urllib.quote(channel, safe='')))
+            if not os.path.isdir(log.directory):
+                os.makedirs(log.directory)
+            self.channels[channel] = log
+        return self.channels[channel]
+
+    def _roll(self, log):
+        # Start a new segment. The old one is left for the sync thread to
+        # fsync, through a duplicate of its descriptor, so that a roll does
+        # not hold up the callers of append, who hold their own locks too.
+        if log.file is not None:
+            log.file.flush()
+            log.rolled.append(os.dup(log.file.fileno()))
+            log.file.close()
+        segment = Segment(os.path.join(log.directory, '%020d.log' % log.head), log.head)
+        log.segments.append(segment)
+        log.file = open(segment.path, 'ab')
+        log.size = 0
+
+    def _replay_channel(self, channel):
+        log = self._channel(channel)
+        cursor = os.path.join(log.directory, CURSOR)
+        if os.path.exists(cursor):
+            with open(cursor) as f:
+                log.consumed = log.saved = int(f.read() or 0)
+        messages = []
+        names = sorted(name for name in os.listdir(log.directory) if name.endswith('.log'))
+        for name in names:
+            segment = Segment(os.path.join(log.directory, name), int(name[:-len('.log')]))
+            records, size = read_segment(segment.path)
+            log.segments.append(segment)
+            log.head = segment.first + len(records)
+            log.size = size
+            skip = max(0, log.consumed - segment.first)
+            messages.extend(records[skip:])
+        if log.segments:
+            last = log.segments[-1]
+            # Drop any record cut short by a crash, and append after the rest
+            log.file = open(last.path, 'ab')
+            log.file.truncate(log.size)
+        log.consumed = max(log.consumed, log.head - len(messages))
+        self._compact(log)
+        return messages
+
+    def _compact(self, log):
+        # Delete the segments whose every record has been consumed
+        while len(log.segments) > 1 and log.segments[1].first <= log.saved:
+            os.remove(log.segments.pop(0).path)
+            self.compacted += 1
+
+    def _pending(self):
+        return self.written > self.synced or any(log.consumed != log.saved for log in self.channels.values())
+
+    def _sync_forever(self):
+        while True:
+            try:
+                self._sync()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.retry_delay)
+                continue
+            if self.sync_interval:
+                time.sleep(self.sync_interval)
+
+    def _sync(self):
+        # One round: fsync every segment written to, then save the cursors
+        with self.lock:
+            while not self._pending():
+                self.lock.wait()
+            target = self.written
+            synced = [] # (log, descriptors of its closed segments)
+            fds = []
+            for log in self.channels.values():
+                rolled, log.rolled = log.rolled, []
+                if log.dirty and log.file is not None:
+                    log.file.flush()
+                    fds.append(os.dup(log.file.fileno()))
+                if log.dirty or rolled:
+                    synced.append((log, rolled))
+                fds.extend(rolled)
+                log.dirty = False
+        # Sync outside the lock so that appends can go on meanwhile
+        kept = set()
+        try:
+            for fd in fds:
+                os.fsync(fd)
+        except Exception:
+            with self.lock:
+                # Fail the appends waiting on this sync, and retry the segments
+                self.failed = max(self.failed, target)
+                for log, rolled in synced:
+                    log.dirty = True
+                    log.rolled = rolled + log.rolled
+                    kept.update(rolled)
+                self.lock.notify_all()
+            raise
+        finally:
+            for fd in fds:
+                if fd not in kept:
+                    os.close(fd)
+        with self.lock:
+            if fds:
+                self.fsyncs += 1
+            self.synced = max(self.synced, target)
+            self.lock.notify_all()
+            # Cursors are written under the lock, so that a clear cannot
+            # remove a channel, and a new one of that name take its
+            # directory, in the middle of it. They are a few bytes each.
+            for log in self.channels.values():
+                if log.consumed != log.saved:
+                    write_cursor(os.path.join(log.directory, CURSOR), log.consumed)
+                    log.saved = log.consumed
+                    self._compact(log)
+
+def read_segment(path):
+    """ Return the messages in the segment file at path, and the size of
+        the part of it holding complete records.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], 0
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        records = []
+        offset = 0
+        while offset + record_header.size <= size:
+            (length,) = record_header.unpack_from(data, offset)
+            end = offset + record_header.size + length
+            if end > size:
+                break
+            records.append(data[offset + record_header.size:end])
+            offset = end
+        return records, offset
+    finally:
+        data.close()
+
+def write_cursor(path, consumed):
+    """ Replace the cursor file at path in one step. """
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        f.write(str(consumed))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp, path)
+
+# -----------IGNOREBEYOND: test code ---------------
+import shutil
+import tempfile
+import unittest
+
+
+class SegmentLogTestCase(unittest.TestCase):
+    """Test writing, replay and compaction of the log"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, **kw):
+        log = SegmentLog(self.directory, **kw)
+        return log, log.replay()
+
+    def append(self, log, channel, msgs):
+        log.wait(log.append(channel, msgs))
+
+    def waitSaved(self, log, channel):
+        deadline = time.time() + 5
+        while log.channels[channel].saved != log.channels[channel].consumed:
+            self.assertTrue(time.time() < deadline, 'cursor not saved')
+            time.sleep(0.01)
+
+    def segmentFiles(self, channel):
+        return [name for name in os.listdir(os.path.join(self.directory, 'q-' + channel))
+                if name.endswith('.log')]
+
+    def testReplay(self):
+        log, msgs = self.open()
+        self.assertEquals(msgs, {})
+        self.append(log, 'db0', ['a', 'bb'])
+        self.append(log, 'db/1', ['c'])
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['a', 'bb'], 'db/1': ['c']})
+
+    def testTruncatedTail(self):
+        log, _ = self.open()
+        self.append(log, 'db0', ['a', 'bb'])
+        path = os.path.join(self.directory, 'q-db0', self.segmentFiles('db0')[0])
+        with open(path, 'ab') as f:
+            f.write(record_header.pack(100) + 'cut short')
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['a', 'bb']})
+        self.append(log, 'db0', ['c'])
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['a', 'bb', 'c']})
+
+    def testCursor(self):
+        log, _ = self.open()
+        self.append(log, 'db0', ['a', 'b', 'c'])
+        log.consume('db0', 2)
+        self.waitSaved(log, 'db0')
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['c']})
+
+    def testCompaction(self):
+        # Every record fills a segment
+        log, _ = self.open(segment_size=1)
+        self.append(log, 'db0', ['a', 'b', 'c', 'd'])
+        self.assertEquals(len(self.segmentFiles('db0')), 4)
+        log.consume('db0', 3)
+        self.waitSaved(log, 'db0')
+        self.assertEquals(self.segmentFiles('db0'), ['%020d.log' % 3])
+        self.assertEquals(log.stats()['compacted'], 3)
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['d']})
+
+    def testRollWithoutSync(self):
+        # Rolling to a new segment leaves the fsync of the old one to the
+        # sync thread, which covers it before the append is reported synced
+        log, _ = self.open(segment_size=1)
+        calls = []
+        fsync = os.fsync
+        def counted(fd):
+            calls.append(threading.current_thread())
+            fsync(fd)
+        os.fsync = counted
+        try:
+            self.append(log, 'db0', ['a', 'b', 'c'])
+        finally:
+            os.fsync = fsync
+        self.assertEquals(len(calls), 3)
+        self.assertTrue(threading.current_thread() not in calls)
+        self.assertEquals(log.channels['db0'].rolled, [])
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['a', 'b', 'c']})
+
+    def testEmptyBatch(self):
+        log, _ = self.open()
+        done = threading.Event()
+        def put():
+            self.append(log, 'new', [])
+            self.append(log, 'db0', ['a'])
+            done.set()
+        threading.Thread(target=put).start()
+        self.assertTrue(done.wait(5))
+        self.assertEquals(log.stats()['appends'], 1)
+
+    def testSyncFailure(self):
+        log, _ = self.open()
+        log.retry_delay = 0.01
+        fsync = os.fsync
+        def broken(fd):
+            raise OSError('disk full')
+        os.fsync = broken
+        try:
+            self.assertRaises(IOError, self.append, log, 'db0', ['a'])
+        finally:
+            os.fsync = fsync
+        self.append(log, 'db0', ['b'])
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['a', 'b']})
+
+    def testClear(self):
+        log, _ = self.open()
+        self.append(log, 'db0', ['a'])
+        log.consume('db0', 1)
+        log.clear()
+        self.append(log, 'db0', ['b'])
+        log, msgs = self.open()
+        self.assertEquals(msgs, {'db0': ['b']})
+
+
+if __name__ == "__main__":
+    unittest.main()
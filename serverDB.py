@@ -6,6 +6,9 @@ import sys
 import time
 import math
 import json
+import threading
+import traceback
+from collections import OrderedDict
 
 # Libraries that have to have been installed by pip
 import redis
@@ -14,8 +17,12 @@ import mimeparse
 from bottle import route, run, request, response, abort
 
 # Local libraries
+import codec
+from lrucache import LRUCache
 from queueservice import Queue
-from vectorclock import VectorClock
+from singleflight import SingleFlight
+from vectorclock import CompactVectorClock, isValidClockDict
+from wsgiserver import KeepAliveServer
 
 base_DB_port = 3000
 
@@ -33,14 +40,85 @@ if (len(sys.argv) > 1):
 
 # Gossip globals
 qport = config['qport']
-queue = Queue(qport)
+queue = Queue(qport, config.get('q-pool-size', 1))
 id = config['id']
-digest_list = []
+# Digests waiting to be pushed to our neighbour, at most one per
+# (primary, key): later updates of a key are folded into its digest.
+# digest_updates counts the updates since the last push.
+pending_digests = OrderedDict()
+digest_updates = 0
 db_id = 'db'+str(id)
 ndb = config['ndb']
 
-# Connect to a single Redis instance
-client = redis.StrictRedis(host=config['servers'][0]['host'], port=config['servers'][0]['port'], db=0)
+# 'inline' gossips from within every PUT and GET, as the assignment
+# specifies. 'background' leaves gossip to a worker thread that pulls up
+# to 'gossip-batch' messages at a time, waiting at most 'gossip-interval'
+# seconds for new ones. It pushes the pending digests once there are
+# 'digest-length' updates, as inline gossip does, and also pushes whatever
+# is pending at the end of every interval, so an idle cluster converges.
+gossip_mode = config.get('gossip-mode', 'inline')
+gossip_interval = config.get('gossip-interval', 0.5)
+gossip_batch = config.get('gossip-batch', None)
+
+# What a digest carries for its key: 'full' sends all the choices and
+# clocks stored for the key after the merge, as the assignment specifies;
+# 'delta' sends only the (choice, clock) siblings merged since the last
+# push, which is all the neighbour needs to reach the same state.
+gossip_state = config.get('gossip-state', 'full')
+
+# Guards pending_digests and gossip_stats, which the background worker
+# and concurrent request handlers share. Merges run outside it: each one
+# is atomic in Redis, and a digest carries its clocks, so digests need
+# not be added in the order of their merges.
+gossip_lock = threading.RLock()
+
+# Gossip metrics, reported by /stats
+gossip_stats = { 'rounds': 0,      # pulls from the queue
+                 'merged': 0,      # messages merged
+                 'pushed': 0,      # digests pushed to the neighbour
+                 'backlog': 0,     # messages left in our channel after the last pull
+                 'lag': 0.0,       # seconds from push to merge of the last message
+                 'max-lag': 0.0,
+                 'recorded': 0,    # updates added to the pending digests
+                 'folded': 0,      # of those, updates folded into an existing digest
+                 'bytes-saved': 0, # payload bytes delta digests saved over full ones
+                 'last-bytes-saved': 0 } # the same, for the last push only
+
+# 'workers' processes serve requests, each with its own gossip state
+# and connections. Within a process, requests are handled one at a time
+# unless 'concurrent' is true.
+workers = config.get('workers', 1)
+concurrent = config.get('concurrent', False)
+
+# Connect to a single Redis instance through a pool of at most
+# 'redis-pool-size' connections per process; a request finding them all
+# busy waits for one to be returned
+redis_pool = redis.BlockingConnectionPool(host=config['servers'][0]['host'],
+                                          port=config['servers'][0]['port'],
+                                          db=0,
+                                          max_connections=config.get('redis-pool-size', 8))
+client = redis.StrictRedis(connection_pool=redis_pool)
+
+# Replies to the most recent GETs of up to 'read-cache-size' keys (none
+# by default), each kept at most 'read-cache-ttl' seconds. Every merge
+# and delete of a key drops its entry. A worker cannot see the writes of
+# the others, so the cache is only used when there is a single worker.
+read_cache = LRUCache(config.get('read-cache-size', 0) if workers == 1 else 0,
+                      config.get('read-cache-ttl', 5.0))
+
+# Unless 'coalesce-reads' is false, concurrent GETs of a key share one
+# read from Redis. A merge or delete of the key makes later GETs wait for
+# a new read.
+coalesce_reads = config.get('coalesce-reads', True)
+read_flight = SingleFlight()
+
+# Encoding of the choices and clocks stored for each key: 'json' or
+# 'msgpack'. Values already stored under either codec, or in the original
+# Python-literal format, are read regardless of this setting.
+value_codec = codec.check_codec(config.get('value-codec', 'json'))
+
+# Server-side merge, loaded with SCRIPT LOAD on first use and then run by its sha
+merge_script = client.register_script(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merge.lua')).read())
 
 # A user updating their rating of something which can be accessed as:
 # curl -XPUT -H'Content-type: application/json' -d'{ "rating": 5, "choices": [3, 4], "clocks": [{ "c1" : 5, "c2" : 3 }] }' http://localhost:3000/rating/bob
@@ -60,37 +138,89 @@ def put_rating(entity):
     # Parse the request
     data = json.load(request.body)
     setrating = data.get('rating')
-    setclock = VectorClock.fromDict(data.get('clock'))
+    # merge.lua compares counters as numbers, so reject any that are not
+    if not isValidClockDict(data.get('clock')): return abort(400)
+    setclock = CompactVectorClock.fromDict(data['clock'])
 
     key = '/rating/'+entity
 
     # YOUR CODE HERE
     # MERGE WITH CURRENT VALUES FOR THIS KEY
     # REPLACE FOLLOWING WITH CORRECT FINAL RATING
-    old_rating = client.hget(key, 'rating')
-    finalrating = old_rating
-
     # if rating does not exist, add it. Otherwise..
     # SET THE RATING, CHOICES, AND CLOCKS IN THE DATABASE FOR THIS KEY
     # COMPUTE THE MEAN, finalrating
     writeToDB = True
     new_choices = []
     new_vcl = []
-    writeToDB, finalrating, new_choices, new_vcl = merge(key, old_rating, setrating, setclock)
-    global digest_list
+    merged = merge(key, setrating, setclock)
+    writeToDB, finalrating, new_choices, new_vcl = merged
 
     # Add to digest list only if the PUT request triggers an update to the DB
     if writeToDB:
-        digest_list.append((db_id, key, finalrating, new_choices, new_vcl))
+        add_digests([make_digest(db_id, key, merged, setrating, setclock)])
 
     # GOSSIP
-    gossip()
+    if gossip_mode == 'inline':
+        gossip()
 
     # Return rating
     return {
             "rating": finalrating
     }
 
+# Update the ratings of several entities at once
+# This can be accessed as:
+# curl -XPUT -H'Content-type: application/json' -d'[{ "entity": "bob", "rating": 5, "clock": { "c1" : 5 } }, { "entity": "alice", "rating": 3, "clock": { "c2" : 1 } }]' http://localhost:3000/ratings
+# All the merges are sent to Redis in one pipeline, and their digests
+# are added together.
+# Response is a JSON object mapping each entity to its new average rating,
+# after the last update of it in the batch:
+# { ratings: { bob: 5, alice: 3 } }
+# If any update fails, the response is a 500 error, but every other
+# update is still applied and gossiped.
+@route('/ratings', method='PUT')
+def put_ratings():
+    mimetype = mimeparse.best_match(['application/json'], request.headers.get('Accept'))
+    if not mimetype: return abort(406)
+    if request.headers.get('Content-Type') != 'application/json': return abort(415)
+    response.headers.append('Content-Type', mimetype)
+
+    items = json.load(request.body)
+    if not isinstance(items, list): return abort(400)
+    updates = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('entity'), basestring): return abort(400)
+        if not isinstance(item.get('rating'), (int, float)): return abort(400)
+        if not isValidClockDict(item.get('clock')): return abort(400)
+        # Key entities by their UTF-8 bytes, as a single PUT's URL has them
+        entity = item['entity']
+        if isinstance(entity, unicode): entity = entity.encode('utf-8')
+        updates.append(('/rating/'+entity, item['rating'], CompactVectorClock.fromDict(item['clock'])))
+
+    # Gossip every merge that was applied, even if others in the batch failed
+    digests = []
+    ratings = {}
+    failed = 0
+    for (key, setrating, setclock), merged in zip(updates, merge_many(updates)):
+        if isinstance(merged, Exception):
+            failed += 1
+            continue
+        writeToDB, finalrating, new_choices, new_vcl = merged
+        if writeToDB:
+            digests.append(make_digest(db_id, key, merged, setrating, setclock))
+        ratings[key[len('/rating/'):]] = finalrating
+    add_digests(digests)
+
+    if gossip_mode == 'inline':
+        gossip()
+
+    if failed:
+        return abort(500, '%d of %d updates failed' % (failed, len(updates)))
+    return {
+        'ratings': ratings
+    }
+
 # Get the aggregate rating of entity
 # This can be accesed as:
 #   curl -XGET http://localhost:3000/rating/bob
@@ -102,14 +232,60 @@ def put_rating(entity):
 def get_rating(entity):
     # YOUR CODE HERE
     # GOSSIP
-    gossip()
+    if gossip_mode == 'inline':
+        gossip()
 
     key = '/rating/' + entity
 
     # GET THE VALUE FROM THE DATABASE
     # RETURN IT, REPLACING FOLLOWING
-    rating = client.hget(key, 'rating')
+    reply = read_cache.get(key)
+    if reply is None:
+        epoch = read_cache.epoch
+        def read():
+            rating, choices, clocks = client.hmget(key, 'rating', 'choices', 'clocks')
+            return rating_reply(rating, choices, clocks)
+        reply = read_flight.do(key, read) if coalesce_reads else read()
+        read_cache.put(key, reply, epoch)
+    return reply
+
+# Get the aggregate ratings of several entities at once
+# This can be accessed as:
+#   curl -XGET 'http://localhost:3000/ratings?entity=bob&entity=alice'
+# All the keys not in the read cache are read in one pipelined round
+# trip to Redis.
+# Response is a JSON object mapping each entity to what a GET of
+# /rating/<entity> would return:
+#   { ratings: { bob: { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] } } }
+# This function also causes a gossip merge
+@route('/ratings', method='GET')
+def get_ratings():
+    if gossip_mode == 'inline':
+        gossip()
+
+    ratings = {}
+    misses = []
+    for entity in request.query.getall('entity'):
+        reply = read_cache.get('/rating/' + entity)
+        if reply is None:
+            misses.append(entity)
+        else:
+            ratings[entity] = reply
+
+    epoch = read_cache.epoch
+    pipe = client.pipeline(transaction=False)
+    for entity in misses:
+        pipe.hgetall('/rating/' + entity)
+    for entity, stored in zip(misses, pipe.execute()):
+        ratings[entity] = rating_reply(stored.get('rating'), stored.get('choices'), stored.get('clocks'))
+        read_cache.put('/rating/' + entity, ratings[entity], epoch)
+    return {
+        'ratings': ratings
+    }
 
+# The reply to a GET of a key whose stored fields are rating, choices
+# and clocks (all None if the key does not exist)
+def rating_reply(rating, choices, clocks):
     # if the rating does not exist
     if rating == None:
         return {
@@ -118,8 +294,9 @@ def get_rating(entity):
             'clocks': []
         }
 
-    choices = eval(client.hget(key, 'choices'))
-    clocks = eval(client.hget(key, 'clocks'))
+    # msgpack stores whole-number choices as integers
+    choices = [float(choice) for choice in codec.decode(choices)]
+    clocks = codec.decode_clocks(clocks)
     
     return {
         'rating': rating,
@@ -136,15 +313,54 @@ def get_rating(entity):
 def delete_rating(entity):
     # ALREADY DONE--YOU DON'T NEED TO ADD ANYTHING
     count = client.delete('/rating/'+entity)
+    changed('/rating/'+entity)
     if count == 0: return abort(404)
     return { "rating": None }
 
+# Report statistics for this DB instance
+# This can be accessed as:
+#   curl -XGET http://localhost:3000/stats
+# Response is a JSON object whose 'queue-pool' entry gives the size of
+# the connection pool to the queue server and how many requests reused
+# a pooled connection (hits) or opened a new one (misses), whose
+# 'read-cache' entry shows how many GETs the read cache answered without
+# going to Redis (hits), whose 'reads' entry gives how many GETs each
+# read from Redis served (fan-in), and whose
+# 'gossip' entry gives the gossip counters, the queue backlog seen at the
+# last pull, and the delay between a neighbour pushing a message and
+# this instance merging it. With several 'workers', each reports its own
+# counters, identified by 'worker', its process id. 'fold-ratio' is the
+# fraction of updates folded into a digest already pending for their key:
+#   { worker: 4242, queue-pool: { size: 1, hits: 57, misses: 1 },
+#     read-cache: { size: 20, maxsize: 1000, hits: 480, misses: 20, hit-ratio: 0.96 },
+#     reads: { requests: 500, executions: 125, fan-in: 4.0 },
+#     gossip: { mode: 'inline', state: 'delta', rounds: 40, merged: 12, pushed: 20,
+#               pending: 1, backlog: 0, lag: 0.02, max-lag: 0.4,
+#               recorded: 30, folded: 10, fold-ratio: 0.33,
+#               bytes-saved: 5120, last-bytes-saved: 96 } }
+@route('/stats', method='GET')
+def get_stats():
+    with gossip_lock:
+        recorded = gossip_stats['recorded']
+        stats = dict(gossip_stats, mode=gossip_mode, state=gossip_state, pending=len(pending_digests),
+                     **{'fold-ratio': float(gossip_stats['folded']) / recorded if recorded else 0.0})
+    return {
+        'worker': os.getpid(),
+        'queue-pool': queue.pool_stats(),
+        'read-cache': read_cache.stats(),
+        'reads': read_flight.stats(),
+        'gossip': stats
+    }
+
 # Merge ratings and update DB. Return empty list of choices and clocks if setclock is 
 # older than any of the existing clocks in the DB.
+# The read, compare and write happen in one call to the merge.lua script,
+# so they cost a single Redis round trip and concurrent merges of the
+# same key cannot interleave. The script also stores the sum and count of
+# the choices in the key's 'sum' and 'count' fields, summing the choices
+# that survive in the same pass that compares their clocks.
 # PARAMS:
 #    key       - key for the tea
-#    oldrating - old rating (can be None, in which case the old rating will be retrieved
-#                from the DB here)
 #    setrating - new rating
 #    setclock  - clock to be compared to vcl
 # RETURN:
@@ -152,112 +368,210 @@ def delete_rating(entity):
 #    finalrating - the average rating for the tea
 #    new_choices - the merged choices of ratings with corresponding clocks in new_vcl 
 #    new_vcl     - the merged list of clocks
-def merge(key, oldrating, setrating, setclock):
-    finalrating = oldrating
-    if oldrating == None:
-        finalrating = client.hget(key, 'rating')
-        # if a rating for the tea is not found in the DB, the rating is new. Add it.
-        if finalrating == None:
-            client.hset(key, 'rating', setrating)
-            client.hset(key, 'choices', [setrating])
-            client.hset(key, 'clocks', jsonify_vcl([setclock]))
-            return True, setrating, [setrating], [setclock]
-    choices = eval(client.hget(key, 'choices'))
-    vcl = eval(client.hget(key, 'clocks'))
-    new_vcl = []
-    new_choices = []
-    greaterThanAlreadyFound = False
-    writeToDB = True
-    for i in range(0, len(vcl)):
-        old_clock = VectorClock.fromDict(vcl[i])
-        # if the received clock is older, nothing needs updating
-        if setclock <= old_clock:
-            writeToDB = False
-            break
-        else:
-            # if the received clock is newer, make changes accordingly
-            if setclock > old_clock:
-                # If we have not found an older clock and replaced it with the 
-                # new one previously, put this new clock in. Otherwise, ignore.
-                if not greaterThanAlreadyFound:
-                    greaterThanAlreadyFound = True
-                    new_vcl.append(setclock)
-                    new_choices.append(setrating)
-            # incomparable
+def merge(key, setrating, setclock):
+    reply = merge_script(keys=[key], args=merge_args(setrating, setclock))
+    changed(key)
+    return merge_result(reply)
+
+# Merge each (key, setrating, setclock) of updates, in order, in a single
+# pipelined round trip to Redis, and return the results of merge for each,
+# or the exception for each merge that failed; the others are still applied
+def merge_many(updates):
+    pipe = client.pipeline(transaction=False)
+    for key, setrating, setclock in updates:
+        merge_script(keys=[key], args=merge_args(setrating, setclock), client=pipe)
+    replies = pipe.execute(raise_on_error=False)
+    for key, _, _ in updates:
+        changed(key)
+    return [reply if isinstance(reply, Exception) else merge_result(reply) for reply in replies]
+
+# Drop everything read of key before a write of it
+def changed(key):
+    read_flight.forget(key)
+    read_cache.invalidate(key)
+
+def merge_args(setrating, setclock):
+    return [repr(float(setrating)), json.dumps(setclock.asDict()), value_codec]
+
+# Decode the reply of merge.lua
+def merge_result(reply):
+    written, finalrating, choices, clocks = reply
+    if not written:
+        return False, finalrating, [], []
+    new_choices = [float(choice) for choice in codec.decode(choices)]
+    new_vcl = [CompactVectorClock.fromDict(vc) for vc in codec.decode_clocks(clocks)]
+    return True, float(finalrating), new_choices, new_vcl
+
+# The digest telling our neighbour that setrating, setclock
+# was merged into key, where merged is what merge returned for it:
+#   (primary, key, rating, choices, clocks, full state)
+# where a delta digest's full state is the (choices, clocks) stored for
+# key after the merge, which push_gossip sizes to count the bytes saved
+def make_digest(primary, key, merged, setrating, setclock):
+    _, rating, new_choices, new_vcl = merged
+    if gossip_state == 'delta':
+        return (primary, key, rating, [setrating], [setclock], (new_choices, new_vcl))
+    return (primary, key, rating, new_choices, new_vcl, None)
+
+# Add each of digests to those pending, folding it into any digest
+# already pending for its key
+def add_digests(digests):
+    global digest_updates
+    with gossip_lock:
+        for digest in digests:
+            update = (digest[0], digest[1])
+            if update in pending_digests:
+                pending_digests[update] = fold_digest(pending_digests[update], digest)
+                gossip_stats['folded'] += 1
             else:
-                new_vcl.append(old_clock)
-                new_choices.append(choices[i])
-
-    # Update lists only if the received clock is not older than or the same as any of the
-    # existing clocks. Otherwise, return empty choices.
-    if writeToDB:
-        # if the received clock is not newer than any of the existing clocks, it's
-        # incomparable
-        if not greaterThanAlreadyFound:
-            new_vcl.append(setclock)
-            new_choices.append(setrating)
-
-        # calculate the new rating
-        ratingSum = 0.0
-        for choice in new_choices:
-            ratingSum+=choice
-        finalrating = ratingSum/len(new_choices)
-
-        # update DB
-        client.hset(key, 'rating', finalrating)
-        client.hset(key, 'choices', new_choices)
-        client.hset(key, 'clocks', jsonify_vcl(new_vcl))
-    else:
-        new_vcl = []
-        new_choices = []
-
-    return writeToDB, finalrating, new_choices, new_vcl
+                pending_digests[update] = digest
+            gossip_stats['recorded'] += 1
+            digest_updates += 1
+
+# One digest for the key of digests old and newer, holding their siblings
+# that no other sibling supersedes, and the rating and full state of newer
+def fold_digest(old, newer):
+    primary, key, rating, choices, clocks, full = newer
+    choices, clocks = latest_siblings(old[3] + choices, old[4] + clocks)
+    return (primary, key, rating, choices, clocks, full)
+
+# The (choices, clocks) siblings whose clocks no other clock is descended
+# from, in their original order
+def latest_siblings(choices, clocks):
+    survivors = CompactVectorClock.coalesce(clocks)
+    kept_choices = []
+    kept_clocks = []
+    j = 0
+    for i in range(len(clocks)):
+        if j < len(survivors) and clocks[i] is survivors[j]:
+            j += 1
+            kept_choices.append(choices[i])
+            kept_clocks.append(clocks[i])
+    return kept_choices, kept_clocks
 
 # Gossip protocol
-def gossip():
-    global digest_list
-    while 1:
-        msg = queue.get(db_id)
-        # Stop if there's no message in the queue
-        if msg == None:
-            break
-        # Merge and pass on if the message was not originally PUT by this DB instance
-        elif msg['primary'] != db_id:
-            rating = None
-            choices = []
-            clocks = []
-            for i in range(len(msg['clocks'])):
-                key = msg['key']
-                _, rating, choices, clocks = merge(key, None, msg['choices'][i], msg['clocks'][i])
-                digest_list.append((msg['primary'], key, rating, choices, clocks))
-
-    # At 'config['digest-length']'th write, fire everything in digest list to its neighbor
-    if len(digest_list) >= config['digest-length']:
-        nextNeighbor = 'db'+str((id+1)%ndb)
-        for digest in digest_list:
-	    (primary, key, rating, choices, clocks) = digest
-            queue.put(nextNeighbor, {'primary': primary, 'key': key, 'rating': rating, 'choices': choices, 'clocks': clocks})
-        digest_list = []
-
-# Turn a list of vector clocks into a JSON formatted string to be stored in redis
-def jsonify_vcl(vcl):
-    i = 0
-    json_str = '['
-    for vc in vcl:
-        json_str = json_str+'{'
-        i += 1
-        j = 0
-        for key in vc.clock.keys():
-            json_str = json_str+'"'+key+'"'+': '+str(vc.clock[key])
-            j+=1
-            if j < len(vc.clock.keys()):
-                json_str = json_str+', '
-        json_str = json_str+'}'
-        if i < len(vcl):
-            json_str = json_str + ', '
-    json_str = json_str+']'
-    return json_str
+def gossip(max_items=None, wait=None):
+    pull_gossip(max_items, wait)
+    push_gossip()
+
+# Merge up to max_items messages from our channel (all of them if None),
+# waiting up to wait seconds for one to arrive if the channel is empty
+def pull_gossip(max_items=None, wait=None):
+    msgs = queue.get_many(db_id, max_items, wait)
+    now = time.time()
+    with gossip_lock:
+        gossip_stats['rounds'] += 1
+        gossip_stats['backlog'] = queue.backlog(db_id)
+
+        # Gather the (choice, clock) siblings of every key, so that those
+        # superseded by a later message in the same batch are never merged
+        updates = {}  # (primary, key) => [choices, clocks]
+        last = {}     # (primary, key) => its latest message
+        order = []
+        for msg in msgs:
+            if 'sent' in msg:
+                gossip_stats['lag'] = now - msg['sent']
+                gossip_stats['max-lag'] = max(gossip_stats['max-lag'], gossip_stats['lag'])
+            # Merge and pass on if the message was not originally PUT by this DB instance
+            if msg['primary'] != db_id:
+                gossip_stats['merged'] += 1
+                update = (msg['primary'], msg['key'])
+                if update not in updates:
+                    updates[update] = [[], []]
+                    order.append(update)
+                updates[update][0].extend(msg['choices'])
+                updates[update][1].extend(msg['clocks'])
+                last[update] = msg
+
+    siblings = [latest_siblings(*updates[update]) for update in order]
+    for i, update in enumerate(order):
+        primary, key = update
+        choices, clocks = siblings[i]
+        try:
+            for choice, clock in zip(choices, clocks):
+                merged = merge(key, choice, clock)
+                add_digests([make_digest(primary, key, merged, choice, clock)])
+        except Exception:
+            # The messages have left the queue, so put back those not yet
+            # merged for the next round; merging a sibling again is harmless
+            queue.put_many(db_id, [dict(last[u], choices=choices, clocks=clocks)
+                                   for u, (choices, clocks) in zip(order[i:], siblings[i:])])
+            raise
+
+# At 'config['digest-length']'th update, fire every pending digest to its neighbor;
+# if flush, fire any that are pending however few
+def push_gossip(flush=False):
+    global digest_updates
+    with gossip_lock:
+        if digest_updates < config['digest-length'] and not (flush and pending_digests):
+            return
+        pending = pending_digests.values()
+        updates = digest_updates
+        pending_digests.clear()
+        digest_updates = 0
+    nextNeighbor = 'db'+str((id+1)%ndb)
+    msgs = []
+    saved = 0
+    sent = time.time()
+    for digest in pending:
+        (primary, key, rating, choices, clocks, full) = digest
+        if full is not None:
+            # Sized once per key, here rather than on every write
+            saved += max(0, payload_size(*full) - payload_size(choices, clocks))
+        msgs.append({'primary': primary, 'key': key, 'rating': rating, 'choices': choices, 'clocks': clocks, 'sent': sent})
+    try:
+        queue.put_many(nextNeighbor, msgs)
+    except Exception:
+        restore_digests(pending, updates)
+        raise
+    with gossip_lock:
+        gossip_stats['pushed'] += len(msgs)
+        gossip_stats['bytes-saved'] += saved
+        gossip_stats['last-bytes-saved'] = saved
+
+# Bytes of JSON that choices and clocks take in a gossip message
+def payload_size(choices, clocks):
+    return len(json.dumps(choices)) + len(json.dumps([vc.asDict() for vc in clocks]))
+
+# Put back the digests of a push that failed, ahead of any added since,
+# so that the next push sends them
+def restore_digests(digests, updates):
+    global pending_digests, digest_updates
+    with gossip_lock:
+        restored = OrderedDict()
+        for digest in digests:
+            update = (digest[0], digest[1])
+            if update in pending_digests:
+                digest = fold_digest(digest, pending_digests.pop(update))
+            restored[update] = digest
+        restored.update(pending_digests)
+        pending_digests = restored
+        digest_updates += updates
+
+# Body of the background gossip thread
+def gossip_worker():
+    last_flush = time.time()
+    while True:
+        try:
+            pull_gossip(gossip_batch, gossip_interval)
+            now = time.time()
+            flush = now - last_flush >= gossip_interval
+            push_gossip(flush)
+            if flush:
+                last_flush = now
+        except Exception:
+            # Most likely the queue server is unreachable; try again later
+            traceback.print_exc()
+            time.sleep(gossip_interval)
+
+# Run in every worker process once it has started
+def start_worker():
+    if gossip_mode == 'background':
+        worker = threading.Thread(target=gossip_worker)
+        worker.daemon = True
+        worker.start()
 
 # Fire the engines
 if __name__ == '__main__':
-    run(host='0.0.0.0', port=os.getenv('PORT', config['hostport']), quiet=True)
+    run(server=KeepAliveServer, workers=workers, serialize=not concurrent, on_start=start_worker,
+        host='0.0.0.0', port=os.getenv('PORT', config['hostport']), quiet=True)
@@ -6,17 +6,21 @@ import sys
 import time
 import math
 import json
-import random
 import string
-import hashlib
+import threading
 
 # Libraries that have to have been installed by pip
-import requests
 import mimeparse
 from bottle import route, run, request, response, abort
 
 # Local libraries
-from vectorclock import VectorClock
+import hashring
+from httppool import PooledClient
+from lrucache import LRUCache
+from routing import Router, ShardLimiter, ShardBusy
+from singleflight import SingleFlight
+from vectorclock import CompactVectorClock, isValidClockDict
+from wsgiserver import KeepAliveServer
 
 # These values are defaults for when you start this server from the command line
 # They are overridden when you run it from test/run.py
@@ -29,7 +33,59 @@ port = config['port']
 ndb = config['ndb']
 dbBasePort = config['db-base-port']
 
-hash_algorithm = 'sha1'
+# Any hashlib algorithm, or 'crc32'/'adler32' for a much cheaper
+# non-cryptographic hash. Every LB must use the same one.
+hash_algorithm = config.get('hash-algorithm', 'sha1')
+
+# How entities are assigned to DB instances: 'modulo' hashes modulo ndb;
+# 'ring' uses a consistent-hash ring with 'vnodes' tokens per DB, so
+# changing ndb only moves about 1/ndb of the entities
+# (see test/reshard.py).
+sharding = config.get('sharding', 'modulo')
+vnodes = config.get('vnodes', 100)
+sharders = {} # numDBs => function from entity to shard
+
+# Most recently routed entities and their shards, for the numDBs in
+# shard_cache_ndb. Sized by 'shard-cache-size'; 0 disables it.
+shard_cache = LRUCache(config.get('shard-cache-size', 10000))
+shard_cache_ndb = ndb
+
+# At most 'shard-concurrency' requests are in flight to each DB instance
+# (no limit by default). A request over the limit waits up to
+# 'shard-wait' seconds for a slot and then fails with 503, so a slow
+# shard holds up only the requests for it.
+limiter = ShardLimiter(config.get('shard-concurrency'), config.get('shard-wait', 5.0))
+
+# Keep-alive connections to the DB instances. 'pool-size' sets the number
+# of connections kept per DB port (by default, enough for
+# 'shard-concurrency' requests); 'pool-sizes' may override it for
+# individual ports, e.g. { "3000": 8 }.
+client = PooledClient(config.get('pool-size', config.get('shard-concurrency') or 1), config.get('pool-sizes'))
+
+# Choice of DB instance for weakly consistent reads: 'random' (the
+# default), 'p2c', 'least-outstanding' or 'ewma'; see routing.Router.
+# Latency and requests in flight are tracked for every DB instance, and
+# one that failed within 'failure-cooldown' seconds is avoided.
+router = Router(config.get('read-routing', 'random'), config.get('ewma-alpha', 0.3),
+                config.get('failure-cooldown', 1.0))
+
+# Replies to weakly consistent reads of up to 'edge-cache-size' entities
+# (none by default), served for at most 'edge-cache-staleness' seconds.
+# A strong read refreshes an entity's entry, and a PUT or DELETE through
+# this load balancer drops it. Concurrent weak reads of an entity that
+# is not cached share one request to a DB instance.
+edge_cache = LRUCache(config.get('edge-cache-size', 0), config.get('edge-cache-staleness', 1.0))
+weak_flight = SingleFlight()
+
+# Unless 'coalesce-reads' is false, concurrent strong reads of an entity
+# share one request to its primary instance. A PUT or DELETE through this
+# load balancer makes later reads wait for a new request.
+coalesce_reads = config.get('coalesce-reads', True)
+strong_flight = SingleFlight()
+
+# Unless 'concurrent' is true, requests are handled one at a time, and
+# there is never more than one request in flight to the DB instances
+concurrent = config.get('concurrent', False)
 
 # Update the rating of entity
 # This can be accessed using;
@@ -51,23 +107,26 @@ def put_rating(entity):
     # Parse the request
     data = json.load(request.body)
     rating = data.get('rating')
-    clock = VectorClock.fromDict(data.get('clock'))
 
-    # Basic sanity checks on the rating
+    # Basic sanity checks on the rating and clock
     if isinstance(rating, int): rating = float(rating)
     if not isinstance(rating, float): return abort(400)
+    if not isValidClockDict(data.get('clock')): return abort(400)
+    clock = CompactVectorClock.fromDict(data['clock'])
 
     # YOUR CODE HERE
     # HASH THE ENTITY TO DETERMINE ITS SHARD
-    # PUT THE PORT FOR THE CORRECT SHARD IN url below 
-    url = 'http://localhost:'+str(dbBasePort+hashEntity(entity, ndb))+'/rating/'+entity
+    # PUT THE CORRECT SHARD IN shard below
+    shard = hashEntity(entity, ndb)
 
     # RESUME BOILERPLATE CODE...
     # Update the rating
-    res = requests.put(url,
-                       data=json.dumps({'rating': rating,
-                                        'clock': clock.asDict()}),
-                       headers={'content-type': 'application/json'})
+    res = forward('PUT', shard, '/rating/'+entity,
+                  data=json.dumps({'rating': rating,
+                                   'clock': clock.asDict()}),
+                  headers={'content-type': 'application/json'})
+    strong_flight.forget(entity)
+    edge_cache.invalidate(entity)
 
     # Return the new rating for the entity
     return {
@@ -75,6 +134,61 @@ def put_rating(entity):
     }
 
 
+# Update the ratings of several entities at once
+# This can be accessed using:
+#   curl -XPUT -H'Content-type: application/json' -d'[{ "entity": "bob", "rating": 5, "clock": { "c1" : 5 } }, { "entity": "alice", "rating": 3, "clock": { "c2" : 1 } }]' http://localhost:2500/ratings
+# The updates are grouped by the primary instance of their entity, and
+# each instance is sent one request for its group, all in parallel.
+# Updates of the same entity are applied in the order given.
+# Response is a JSON object mapping each entity to its new mean rating:
+#   { ratings: { bob: 5, alice: 3 } }
+@route('/ratings', method='PUT')
+def put_ratings():
+    mimetype = mimeparse.best_match(['application/json'], request.headers.get('Accept'))
+    if not mimetype: return abort(406)
+    if request.headers.get('Content-Type') != 'application/json': return abort(415)
+    response.headers.append('Content-Type', mimetype)
+
+    items = json.load(request.body)
+    if not isinstance(items, list): return abort(400)
+    batches = {}
+    for item in items:
+        if not isinstance(item, dict): return abort(400)
+        entity = item.get('entity')
+        rating = item.get('rating')
+        # Same sanity checks as for a single rating
+        if isinstance(rating, int): rating = float(rating)
+        if not isinstance(rating, float) or not isinstance(entity, basestring) or not entity: return abort(400)
+        if not isValidClockDict(item.get('clock')): return abort(400)
+        # Shard and cache entities by their UTF-8 bytes, as a single PUT's URL has them
+        if isinstance(entity, unicode): entity = entity.encode('utf-8')
+        clock = CompactVectorClock.fromDict(item['clock'])
+        batches.setdefault(hashEntity(entity, ndb), []).append({'entity': entity,
+                                                                'rating': rating,
+                                                                'clock': clock.asDict()})
+
+    def store(shard):
+        res = forward('PUT', shard, '/ratings',
+                      data=json.dumps(batches[shard]),
+                      headers={'content-type': 'application/json'})
+        if res.status_code != 200:
+            abort(res.status_code, 'DB instance %d: %s' % (shard, res.reason))
+        return res.json()['ratings']
+
+    ratings = {}
+    try:
+        for batch in parallel(store, batches.keys()):
+            ratings.update(batch)
+    finally:
+        # Even a shard that failed may have applied some of its batch
+        for batch in batches.values():
+            for item in batch:
+                strong_flight.forget(item['entity'])
+                edge_cache.invalidate(item['entity'])
+    return {
+            "ratings": ratings
+    }
+
 # Get the aggregate rating of entity
 # This can be accesed using:
 #   curl -XGET http://localhost:2500/rating/bob
@@ -83,6 +197,7 @@ def put_rating(entity):
 # be faster, as this server might be less-loaded), add a 'consistency=weak'
 # query:
 #  curl -XGET http://localhost:2500/rating/bob?consistency=weak
+# A weak read may be answered from the edge cache.
 # Response is a JSON object specifying the mean rating, choice list and
 # clock list for entity:
 #   { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] }
@@ -91,26 +206,61 @@ def get_rating(entity):
     # YOUR CODE HERE
     # DETERMINE THE RIGHT DB INSTANCE TO CALL,
     # DEPENDING UPON WHETHER THE GET IS STRONGLY OR WEAKLY CONSISTENT
-    # ASSIGN THE ENDPOINT TO url
+    # ASSIGN THE DB INDEX TO shard
     consistency = request.query.get('consistency')
     shard = 0
-    # If weakly consistent, get the rating from a randomly selected DB.
+    # If weakly consistent, get the rating from a DB chosen by the router.
     # Otherwise, hash the entity to get the primary instance.
     if consistency and consistency == 'weak':
-        shard = random.randint(0, ndb-1)
+        if edge_cache.maxsize > 0:
+            curdata = cached_read(entity)
+        else:
+            shard = router.choose(range(ndb))
+            curdata = forward('GET', shard, '/rating/'+entity).json()
     else:
-	shard = hashEntity(entity, ndb)
-
-    url = 'http://localhost:'+str(dbBasePort+shard)+'/rating/'+entity
+        shard = hashEntity(entity, ndb)
+        epoch = edge_cache.epoch
+        curdata = primary_read(entity, shard)
+        edge_cache.put(entity, curdata, epoch)
 
     # RESUME BOILERPLATE
-    curdata = requests.get(url).json()
     return {
             "rating":  curdata['rating'],
             "choices": curdata['choices'],
             "clocks":  curdata['clocks']
     }
 
+# Get the aggregate ratings of several entities at once
+# This can be accessed using:
+#   curl -XGET 'http://localhost:2500/ratings?entity=bob&entity=alice'
+# The entities are grouped by their primary instance, and each instance
+# is sent one request for its group, all in parallel. With
+# 'consistency=weak', a single instance chosen by the router serves
+# the whole batch.
+# Response is a JSON object mapping each entity to what a GET of
+# /rating/<entity> would return:
+#   { ratings: { bob: { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] },
+#                alice: { rating: 0.0, choices: [], clocks: [] } } }
+@route('/ratings', method='GET')
+def get_ratings():
+    entities = request.query.getall('entity')
+    consistency = request.query.get('consistency')
+    if consistency and consistency == 'weak':
+        batches = {router.choose(range(ndb)): entities}
+    else:
+        batches = group_by_shard(entities)
+
+    def fetch(shard):
+        params = [('entity', entity) for entity in batches[shard]]
+        return forward('GET', shard, '/ratings', params=params).json()['ratings']
+
+    ratings = {}
+    for batch in parallel(fetch, batches.keys()):
+        ratings.update(batch)
+    return {
+            "ratings": ratings
+    }
+
 # Delete the rating information for entity
 # This can be accessed using:
 #   curl -XDELETE http://localhost:2500/rating/bob
@@ -119,18 +269,123 @@ def get_rating(entity):
 @route('/rating/<entity>', method='DELETE')
 def delete_rating(entity):
     # DONE---NOTHING TO CHANGE
-    dbprimary = dbBasePort + hashEntity(entity, ndb)
-    url = 'http://localhost:'+str(dbprimary)+'/rating/'+entity
-    resp = requests.delete(url)
+    resp = forward('DELETE', hashEntity(entity, ndb), '/rating/'+entity)
+    strong_flight.forget(entity)
+    edge_cache.invalidate(entity)
     return resp
 
+# Report load balancer statistics
+# This can be accessed using:
+#   curl -XGET http://localhost:2500/stats
+# Response is a JSON object whose 'pool' entry gives, for each DB port,
+# the pool size and how many requests reused a pooled connection (hits)
+# or had to open a new one (misses), and whose 'shard-cache' entry gives
+# the effectiveness of the entity to shard cache, and whose 'routing'
+# entry gives the read routing policy and the load seen on each DB
+# instance (latency is a moving average, in seconds), and whose
+# 'edge-cache' entry gives the effectiveness of the weak read cache and
+# how many of its misses each request to a DB instance served, and whose
+# 'strong-reads' entry gives how many strong reads each request to a
+# primary instance served (fan-in):
+#   { pool: { 3000: { size: 1, hits: 120, misses: 1 } },
+#     shard-cache: { size: 20, maxsize: 10000, hits: 480, misses: 20, hit-ratio: 0.96 },
+#     routing: { policy: 'p2c', shards: { 0: { inflight: 2, latency: 0.004, requests: 310, errors: 0 } } },
+#     shard-limit: { limit: 8, rejected: 0 },
+#     edge-cache: { size: 40, maxsize: 1000, hits: 900, misses: 100, hit-ratio: 0.9,
+#                   fetches: { requests: 100, executions: 60, fan-in: 1.67 } },
+#     strong-reads: { requests: 500, executions: 125, fan-in: 4.0 } }
+@route('/stats', method='GET')
+def get_stats():
+    return {
+        "pool": client.stats(),
+        "shard-cache": shard_cache.stats(),
+        "routing": router.stats(),
+        "shard-limit": limiter.stats(),
+        "edge-cache": dict(edge_cache.stats(), fetches=weak_flight.stats()),
+        "strong-reads": strong_flight.stats()
+    }
+
+# Send a request to DB instance shard, recording its load for the router
+def forward(method, shard, path, **kwargs):
+    try:
+        with limiter.slot(shard):
+            with router.track(shard) as tracked:
+                res = client.request(method, dbBasePort+shard, path, **kwargs)
+                tracked.failed = res.status_code >= 500
+                return res
+    except ShardBusy:
+        abort(503, 'DB instance %d is busy' % shard)
+
+# Map each shard to the distinct entities in entities whose primary
+# instance it is
+def group_by_shard(entities):
+    batches = {}
+    for entity in entities:
+        batch = batches.setdefault(hashEntity(entity, ndb), [])
+        if entity not in batch:
+            batch.append(entity)
+    return batches
+
+# Call f on every shard in shards, each in its own thread, and return the
+# results in the same order. The first exception raised is re-raised.
+def parallel(f, shards):
+    shards = list(shards)
+    if len(shards) == 1:
+        return [f(shards[0])]
+    results = [None] * len(shards)
+    errors = [None] * len(shards)
+    def call(i):
+        try:
+            results[i] = f(shards[i])
+        except Exception:
+            errors[i] = sys.exc_info()
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(shards))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+# Strongly consistent read of entity from shard, its primary instance,
+# shared with any such read of it already in flight
+def primary_read(entity, shard):
+    def fetch():
+        return forward('GET', shard, '/rating/'+entity).json()
+    if not coalesce_reads:
+        return fetch()
+    return strong_flight.do(entity, fetch)
+
+# Weakly consistent read of entity through the edge cache. On a miss, the
+# rating is read from a DB instance chosen by the router, at most one
+# read per entity at a time.
+def cached_read(entity):
+    curdata = edge_cache.get(entity)
+    if curdata is None:
+        epoch = edge_cache.epoch
+        def fetch():
+            return forward('GET', router.choose(range(ndb)), '/rating/'+entity).json()
+        curdata = weak_flight.do(entity, fetch)
+        edge_cache.put(entity, curdata, epoch)
+    return curdata
+
 # Determine the primary instance for the tea
 def hashEntity(entity, numDBs):
-	# Hash the entity to a hexadecimal value and then convert the value to int
-	h = hashlib.new(hash_algorithm)
-	h.update(entity)
-	return int(long(h.hexdigest(), base=16) % numDBs)
+    global shard_cache_ndb
+    if numDBs != shard_cache_ndb:
+        # Every cached shard is for the old number of DBs
+        shard_cache.clear()
+        shard_cache_ndb = numDBs
+    shard = shard_cache.get(entity)
+    if shard is None:
+        if numDBs not in sharders:
+            sharders[numDBs] = hashring.make_sharder(sharding, numDBs, vnodes, hash_algorithm)
+        shard = sharders[numDBs](entity)
+        shard_cache.put(entity, shard)
+    return shard
 
 # Fire the engines
 if __name__ == '__main__':
-    run(host='0.0.0.0', port=os.getenv('PORT', port), quiet=True)
+    run(server=KeepAliveServer, serialize=not concurrent, host='0.0.0.0', port=os.getenv('PORT', port), quiet=True)
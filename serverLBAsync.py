@@ -0,0 +1,26 @@
+#  Asynchronous load balancer for Assignment 6, CMPT 474, Spring 2014
+#
+# Serves exactly the routes of serverLB.py, and takes the same config
+# argument, but on gevent: every request runs in its own greenlet, and
+# the calls to the DB instances are non-blocking, so a slow shard only
+# holds up the requests waiting on it. Run it in place of serverLB.py:
+#   python serverLBAsync.py '{"port": 2500, "db-base-port": 3000, "ndb": 4, "shard-concurrency": 8}'
+# 'shard-concurrency' bounds the requests in flight to each DB instance
+# and sizes its connection pool.
+
+# Must come before anything else imports socket or threading
+from gevent import monkey
+monkey.patch_all()
+
+# Core libraries
+import os
+
+# Libraries that have to have been installed by pip
+from bottle import run
+
+# Local libraries
+import serverLB
+
+# Fire the engines
+if __name__ == '__main__':
+    run(server='gevent', host='0.0.0.0', port=os.getenv('PORT', serverLB.port), quiet=True)
@@ -4,10 +4,17 @@
 import os
 import sys
 import json
+import time
+import threading
+from collections import deque
 
 # Libraries that have to have been installed by pip
 from bottle import route, run, request, response, abort
 
+# Local libraries
+from segmentlog import SegmentLog
+from wsgiserver import KeepAliveServer
+
 config = {'id':0, 'port': 6000, 'nq':1, 'ndb': 1 }
 if (len(sys.argv) > 1):
     config = json.loads(sys.argv[1])
@@ -15,28 +22,128 @@ if (len(sys.argv) > 1):
 port = config['port']
 ndb = config['ndb']
 
-queue = {} # Dictionary of queue channels
+queue = {} # Dictionary of queue channels, each a deque of messages
+high_water = {} # Largest length each channel has reached since the last clear
+
+# Requests are served concurrently so that a blocking GET does not hold
+# up the PUT it is waiting for. This condition guards queue and
+# high_water, and is notified whenever messages are pushed.
+arrival = threading.Condition()
+
+# Longest a blocking GET may wait, in seconds
+max_wait = config.get('max-wait', 60)
+
+# With a 'data-dir', every channel is also kept in an append-only log
+# there, in segments of 'segment-size' bytes, and the messages not yet
+# taken when the server stopped are queued again when it starts. A PUT
+# returns once its messages are on disk, unless 'sync' is 'async'; the
+# log is synced at most every 'sync-interval' seconds, each fsync
+# covering every PUT made since the last.
+log = None
+if config.get('data-dir'):
+    log = SegmentLog(config['data-dir'],
+                     config.get('segment-size', 4 << 20),
+                     config.get('sync', 'group'),
+                     config.get('sync-interval', 0.0))
+    for channel, msgs in log.replay().items():
+        queue[channel] = deque(msgs)
+
+# Read the 'wait' query parameter of a GET. Returns None if it is malformed.
+def wait_time():
+    try:
+        return min(max(float(request.query.get('wait', 0)), 0), max_wait)
+    except ValueError:
+        return None
+
+# Block until channel has at least one message or timeout seconds pass.
+# Must be called with arrival held.
+def wait_for(channel, timeout):
+    deadline = time.time() + timeout
+    while channel not in queue or len(queue[channel]) == 0:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        arrival.wait(remaining)
+
+# Record the current length of channel against its high-water mark
+# and return both, for inclusion in a response
+def channel_stats(channel):
+    length = len(queue[channel]) if channel in queue else 0
+    if length > high_water.get(channel, 0):
+        high_water[channel] = length
+    return length, high_water.get(channel, 0)
 
 # Push to the queue
 # This can be accessed using;
 #   curl -XPUT -H'Content-type: application/json' -d<message> http://localhost:6000/q/<channel>
-# Response is a JSON object specifying the number of items in the channel:
-#   { channel: name, length: 5 }
+# A message that is not valid JSON is rejected with 400.
+# Response is a JSON object specifying the number of items in the channel
+# and the most it has held since the last clear:
+#   { channel: name, length: 5, high-water: 12 }
 @route('/q/<channel>', method='PUT')
 def put_item(channel):
     global queue
     # Check to make sure the data we're getting is JSON
     if request.headers.get('Content-Type') != 'application/json': return abort(415)
 
-    if channel not in queue:
-        queue[channel] = []
-    queue[channel].append(request.body)
+    # A batch GET returns messages as they were stored, so each must be JSON
+    msg = request.body.read()
+    try:
+        json.loads(msg)
+    except ValueError:
+        return abort(400)
+    with arrival:
+        if channel not in queue:
+            queue[channel] = deque()
+        queue[channel].append(msg)
+        if log: ticket = log.append(channel, [msg])
+        arrival.notify_all()
+        length, hwm = channel_stats(channel)
+    if log: log.wait(ticket)
 
     response.headers.append('Content-Type', 'application/json')
     # Return the number of messages in the queue
     return {
         "channel": channel,
-        "length": len(queue[channel])
+        "length": length,
+        "high-water": hwm
+    }
+
+
+# Push several messages to the queue at once
+# This can be accessed using;
+#   curl -XPUT -H'Content-type: application/json' -d'[<message>, <message>]' http://localhost:6000/q/<channel>/batch
+# The messages are appended in order, and either all of them are
+# queued or (if the body is not a JSON list) none are.
+# Response is the same as for a single PUT:
+#   { channel: name, length: 5, high-water: 12 }
+@route('/q/<channel>/batch', method='PUT')
+def put_items(channel):
+    global queue
+    # Check to make sure the data we're getting is JSON
+    if request.headers.get('Content-Type') != 'application/json': return abort(415)
+
+    try:
+        msgs = json.load(request.body)
+    except ValueError:
+        return abort(400)
+    if not isinstance(msgs, list): return abort(400)
+
+    msgs = [json.dumps(msg) for msg in msgs]
+    with arrival:
+        if channel not in queue:
+            queue[channel] = deque()
+        queue[channel].extend(msgs)
+        if log: ticket = log.append(channel, msgs)
+        arrival.notify_all()
+        length, hwm = channel_stats(channel)
+    if log: log.wait(ticket)
+
+    response.headers.append('Content-Type', 'application/json')
+    return {
+        "channel": channel,
+        "length": length,
+        "high-water": hwm
     }
 
 
@@ -47,13 +154,57 @@ def put_item(channel):
 #   { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] }
 # or (for an empty channel)
 #   {  }
+# To block until an item arrives, rather than return an empty one,
+# give the longest time to wait in seconds:
+#   curl -XGET http://localhost:6000/q/<channel>?wait=5
+# The channel length remaining after the GET and its high-water mark are
+# returned in the X-Queue-Length and X-Queue-High-Water headers.
 @route('/q/<channel>', method='GET')
 def get_item(channel):
-    if channel in queue and len(queue[channel]) > 0:
-        item, queue[channel] = queue[channel][0], queue[channel][1:]
-        return item
-    else:
-        return {}
+    wait = wait_time()
+    if wait is None: return abort(400)
+    item = '{}'
+    with arrival:
+        wait_for(channel, wait)
+        if channel in queue and len(queue[channel]) > 0:
+            item = queue[channel].popleft()
+            if log: log.consume(channel, 1)
+        length, hwm = channel_stats(channel)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['X-Queue-Length'] = str(length)
+    response.headers['X-Queue-High-Water'] = str(hwm)
+    return item
+
+# Get up to max items from a channel in a single response. If max is
+# omitted, the whole channel is drained.
+# This can be accessed using:
+#   curl -XGET http://localhost:6000/q/<channel>/batch?max=10
+# Response is a JSON list of items, oldest first, which is empty if
+# the channel is empty:
+#   [ { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] }, ... ]
+# As for a single GET, a 'wait' parameter blocks until at least one
+# item is available. The length and high-water headers are also set.
+@route('/q/<channel>/batch', method='GET')
+def get_items(channel):
+    try:
+        max_items = int(request.query.get('max', -1))
+    except ValueError:
+        return abort(400)
+    wait = wait_time()
+    if wait is None: return abort(400)
+    items = []
+    with arrival:
+        wait_for(channel, wait)
+        if channel in queue:
+            chan = queue[channel]
+            while len(chan) > 0 and len(items) != max_items:
+                items.append(chan.popleft())
+            if log and items: log.consume(channel, len(items))
+        length, hwm = channel_stats(channel)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['X-Queue-Length'] = str(length)
+    response.headers['X-Queue-High-Water'] = str(hwm)
+    return '[' + ', '.join(items) + ']'
 
 # Clear all the items currently in-flight in the queue.
 # Use for debugging and testing.
@@ -65,14 +216,36 @@ def get_item(channel):
 #  { 'db0': 2, 'db5': 12}
 @route('/clear', method='DELETE')
 def clear_queue():
-    global queue
+    global queue, high_water
     chans = {}
-    for key in queue:
-        chans[key] = len(queue[key])
-    queue = {}
+    with arrival:
+        for key in queue:
+            chans[key] = len(queue[key])
+        queue = {}
+        high_water = {}
+        if log: log.clear()
     return chans
 
+# Report the length and high-water mark of every channel, and the work
+# done by the log (null without a 'data-dir')
+# This can be accessed using:
+#  curl -XGET http://localhost:6000/stats
+# Response is a JSON object:
+#  { channels: { db0: { length: 2, high-water: 12 } },
+#    log: { segments: 3, appends: 500, fsyncs: 40, appends-per-fsync: 12.5, compacted: 7 } }
+@route('/stats', method='GET')
+def get_stats():
+    channels = {}
+    with arrival:
+        for channel in queue:
+            length, hwm = channel_stats(channel)
+            channels[channel] = {'length': length, 'high-water': hwm}
+    return {
+        'channels': channels,
+        'log': log.stats() if log else None
+    }
+
 
 # Fire the engines
 if __name__ == '__main__':
-    run(host='0.0.0.0', port=os.getenv('PORT', port), quiet=True)
+    run(server=KeepAliveServer, serialize=False, host='0.0.0.0', port=os.getenv('PORT', port), quiet=True)
@@ -0,0 +1,159 @@
+# CMPT 474 Spring 2014, Assignment 6
+# Sharing of one upstream call among concurrent identical requests
+
+# Core libraries
+import sys
+import threading
+
+class Call(object):
+    """ One execution of a function, and its outcome once done is set. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None # sys.exc_info() of the exception raised, if any
+
+class SingleFlight(object):
+    """ Run at most one call per key at a time. A caller asking for a key
+        whose call is already running waits for it and gets its result,
+        or its exception, instead of making another.
+    """
+    def __init__(self):
+        self.calls = {} # key => Call running now
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.executions = 0
+
+    def do(self, key, f):
+        """ Return f(), or the result of the call of f already running for key. """
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executions += 1
+        if leader:
+            try:
+                call.result = f()
+            except Exception:
+                call.error = sys.exc_info()
+            finally:
+                with self.lock:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
+
+    def forget(self, key):
+        """ Let the next caller for key make a new call rather than wait for
+            the one running now, which may have read data since changed.
+        """
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def stats(self):
+        """ Return { requests, executions, fan-in }, where fan-in is the
+            mean number of requests served by each execution.
+        """
+        with self.lock:
+            return {'requests': self.requests,
+                    'executions': self.executions,
+                    'fan-in': float(self.requests) / self.executions if self.executions else 0.0}
+
+# -----------IGNOREBEYOND: test code ---------------
+import time
+import unittest
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Test sharing of calls among concurrent callers"""
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.results = {}
+
+    def blocking(self, value):
+        def f():
+            self.started.set()
+            self.release.wait(5)
+            return value
+        return f
+
+    def call(self, name, key, f):
+        def run():
+            try:
+                self.results[name] = self.flight.do(key, f)
+            except Exception as e:
+                self.results[name] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def waitCallers(self, n):
+        # The followers of a call have counted their request before waiting
+        deadline = time.time() + 5
+        while self.flight.stats()['requests'] < n:
+            self.assertTrue(time.time() < deadline, 'callers did not arrive')
+            time.sleep(0.01)
+
+    def testShared(self):
+        leader = self.call('leader', 'k', self.blocking('first'))
+        self.assertTrue(self.started.wait(5))
+        follower = self.call('follower', 'k', self.blocking('second'))
+        self.waitCallers(2)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEquals(self.results, {'leader': 'first', 'follower': 'first'})
+        self.assertEquals(self.flight.stats(), {'requests': 2, 'executions': 1, 'fan-in': 2.0})
+        # Once the call is done, the next caller makes a new one
+        self.assertEquals(self.flight.do('k', lambda: 'third'), 'third')
+
+    def testForget(self):
+        old = self.call('old', 'k', self.blocking('old'))
+        self.assertTrue(self.started.wait(5))
+        self.flight.forget('k')
+        # A caller after forget starts its own call rather than wait
+        self.started.clear()
+        release = self.release
+        self.release = threading.Event()
+        new = self.call('new', 'k', self.blocking('new'))
+        self.assertTrue(self.started.wait(5))
+        self.assertEquals(self.flight.stats()['executions'], 2)
+        # The forgotten call finishing must not detach the newer one
+        release.set()
+        old.join()
+        self.assertEquals(self.results['old'], 'old')
+        follower = self.call('follower', 'k', lambda: 'unused')
+        self.waitCallers(3)
+        self.release.set()
+        new.join()
+        follower.join()
+        self.assertEquals(self.results['new'], 'new')
+        self.assertEquals(self.results['follower'], 'new')
+        self.assertEquals(self.flight.stats()['executions'], 2)
+
+    def testError(self):
+        def fail():
+            self.started.set()
+            self.release.wait(5)
+            raise ValueError('upstream down')
+        leader = self.call('leader', 'k', fail)
+        self.assertTrue(self.started.wait(5))
+        follower = self.call('follower', 'k', lambda: 'unused')
+        self.waitCallers(2)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertTrue(isinstance(self.results['leader'], ValueError))
+        self.assertTrue(isinstance(self.results['follower'], ValueError))
+
+
+if __name__ == "__main__":
+    unittest.main()
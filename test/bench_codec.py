@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# CMPT 474, Spring 2014, Assignment 6
+# Micro-benchmark of the value codecs used for the choices and clocks of a key.
+# The stored bytes are those merge.lua writes, so a Redis server is needed.
+
+# Core libraries
+import os
+import sys
+import json
+import timeit
+import random
+import argparse
+import itertools
+
+# Libraries that must be installed via pip
+import redis
+
+# Extend path to our containing directory, so we can import codec
+sys.path.append(sys.path[0]+'/..')
+
+# File distributed with assignment boilerplate
+import codec
+
+parser = argparse.ArgumentParser(description='Time encoding and decoding of one key.')
+
+parser.add_argument('--siblings',
+                    dest='siblings',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=4,
+                    help='number of (choice, clock) siblings per key; default %(default)s')
+
+parser.add_argument('--nodes',
+                    dest='nodes',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=8,
+                    help='number of nodes in each clock; default %(default)s')
+
+parser.add_argument('--number',
+                    dest='number',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=20000,
+                    help='iterations per measurement; default %(default)s')
+
+parser.add_argument('--redis-port',
+                    dest='port',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=6379,
+                    help='port of the Redis server merge.lua runs in; default %(default)s')
+
+args = parser.parse_args()
+
+client = redis.StrictRedis(port=args.port)
+merge_script = client.register_script(open(os.path.join(sys.path[0], '..', 'merge.lua')).read())
+key = '/bench/codec'
+
+# Every clock has a node of its own, so no sibling supersedes another
+random.seed(474)
+choices = [float(random.randrange(6)) for i in range(args.siblings)]
+clocks = []
+for i in range(args.siblings):
+    clock = dict(('c'+str(n), random.randrange(1000)) for n in range(args.nodes - 1))
+    clock['s'+str(i)] = 1
+    clocks.append(clock)
+
+def merge(name, choice, clock):
+    merge_script(keys=[key], args=[repr(choice), json.dumps(clock), name])
+
+def store(name):
+    """ Merge every sibling into the key under the codec called name, and
+        return the choices and clocks merge.lua stored.
+    """
+    client.delete(key)
+    for choice, clock in zip(choices, clocks):
+        merge(name, choice, clock)
+    return client.hmget(key, 'choices', 'clocks')
+
+def per_key(f):
+    """ Microseconds for one call of f, best of three runs. """
+    return min(timeit.repeat(f, number=args.number, repeat=3)) / args.number * 1e6
+
+# The original format: Python literals written with str() and read with eval()
+candidates = [('legacy', [str(choices), str(clocks)], lambda data: (eval(data[0]), eval(data[1])))]
+for name in codec.codecs:
+    try:
+        codec.check_codec(name)
+    except Exception as e:
+        print('%-8s skipped: %s' % (name, e))
+        continue
+    candidates.append((name, store(name), lambda data: (codec.decode(data[0]), codec.decode_clocks(data[1]))))
+
+def superseding(name):
+    """ A merge under the codec called name that supersedes the first
+        sibling with a newer clock each time it is called, so merge.lua
+        re-encodes every sibling as it would for a PUT.
+    """
+    counter = itertools.count(2)
+    return lambda: merge(name, choices[0], dict(clocks[0], s0=next(counter)))
+
+print('%d siblings, %d nodes per clock, %d iterations' % (args.siblings, args.nodes, args.number))
+print('merge: one merge.lua call, Redis round trip included (legacy was merged in Python)')
+print('%-8s %8s %12s %12s' % ('codec', 'bytes', 'merge (us)', 'decode (us)'))
+for name, data, decode in candidates:
+    dec = per_key(lambda: decode(data))
+    if name == 'legacy':
+        print('%-8s %8d %12s %12.2f' % (name, len(data[0]) + len(data[1]), '-', dec))
+    else:
+        store(name)
+        enc = per_key(superseding(name))
+        print('%-8s %8d %12.2f %12.2f' % (name, len(data[0]) + len(data[1]), enc, dec))
+client.delete(key)
@@ -129,6 +129,10 @@ def discardOlderRating(results):
 def testDBUnit(results):
     return checkMultiple(results)
 
+@grade(weight=0.05)
+def fractionalRatings(results):
+    return checkMultiple(results)
+
 @grade(weight=0.20)
 def forceGossip(results):
     return checkMultiple(results)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# CMPT 474, Spring 2014, Assignment 6
+# Report how many entities change shard when a DB instance is added or removed
+
+# Core libraries
+import os
+import sys
+import argparse
+
+# Extend path to our containing directory, so we can import hashring
+sys.path.append(sys.path[0]+'/..')
+
+# File distributed with assignment boilerplate
+import hashring
+
+parser = argparse.ArgumentParser(description='Count entities that move between shards when ndb changes.')
+
+parser.add_argument('--ndb',
+                    dest='ndb',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=4,
+                    help='current number of database nodes; default %(default)s')
+
+parser.add_argument('--vnodes',
+                    dest='vnodes',
+                    type=int,
+                    action='store',
+                    nargs='?',
+                    default=100,
+                    help='ring tokens per database node; default %(default)s')
+
+parser.add_argument('--hash',
+                    dest='algorithm',
+                    action='store',
+                    nargs='?',
+                    default='sha1',
+                    help='hash algorithm; default %(default)s')
+
+parser.add_argument('--entities',
+                    dest='entities',
+                    action='store',
+                    nargs='?',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'entities.txt'),
+                    help='file of entity names, one per line; default test/entities.txt')
+
+args = parser.parse_args()
+
+entities = open(args.entities).read().splitlines()
+
+def moved(scheme, before, after):
+    old = hashring.make_sharder(scheme, before, args.vnodes, args.algorithm)
+    new = hashring.make_sharder(scheme, after, args.vnodes, args.algorithm)
+    return len([e for e in entities if old(e) != new(e)])
+
+print('%d entities, %d DBs, %d vnodes per DB' % (len(entities), args.ndb, args.vnodes))
+print('%-8s %-16s %8s %8s' % ('scheme', 'change', 'moved', 'percent'))
+for scheme in ('modulo', 'ring'):
+    changes = [('add a DB', args.ndb + 1)]
+    if args.ndb > 1:
+        changes.append(('remove a DB', args.ndb - 1))
+    for change, after in changes:
+        n = moved(scheme, args.ndb, after)
+        print('%-8s %-16s %8d %7.1f%%' % (scheme, change, n, 100.0 * n / max(len(entities), 1)))
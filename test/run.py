@@ -439,6 +439,20 @@ def testDBUnit(result):
     rating, choices, clocks = get(entity, port=dbp)
     result({'type': 'float', 'expected': 3.0, 'got': rating})
 
+@test()
+def fractionalRatings(result):
+    """ The mean of non-integer ratings is exact after siblings are superseded. """
+    entity = 'gyokuro-asahi-green-tea'
+    put(entity, 0.1, VectorClock().update('a', 1))
+    put(entity, 0.2, VectorClock().update('b', 1))
+    cv = VectorClock().update('a', 1).update('b', 1)
+    put(entity, 0.3, cv)
+    r, ch, cl = get(entity)
+    testResult(result, r, 0.3, ch, [0.3], cl, [cv])
+    # The stored mean must be 0.3 itself, not 0.3 plus rounding error
+    dbid = getDBId(entity)
+    result({'type': 'bool', 'expected': True, 'got': str(clients[dbid].hget(mkKey(entity), 'rating') == repr(0.3))})
+
 def gossipTest(result):
     """ Run a gossip test, using whatever digest_length the test specified. """
     base = 'aardvark'
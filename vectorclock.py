@@ -10,6 +10,25 @@
 '''
 
 import copy
+import threading
+from itertools import izip
+
+# Results of VectorClock.compare(other)
+BEFORE = 'BEFORE'          # self < other
+AFTER = 'AFTER'            # self > other
+EQUAL = 'EQUAL'            # self == other
+CONCURRENT = 'CONCURRENT'  # neither clock is descended from the other
+
+def isValidClockDict(dct):
+    """Return True if dct is a dict of node names to non-negative integer
+    counters, as fromDict expects of a clock sent by a client."""
+    if not isinstance(dct, dict):
+        return False
+    for node, count in dct.iteritems():
+        if (not isinstance(node, basestring) or not isinstance(count, (int, long))
+                or isinstance(count, bool) or count < 0):
+            return False
+    return True
 
 # PART coreclass
 class VectorClock(object):
@@ -55,30 +74,48 @@ class VectorClock(object):
 
 # PART comparisons
     # Comparison operations. Vector clocks are partially ordered, but not totally ordered.
+    def compare(self, other):
+        """Return BEFORE, AFTER, EQUAL or CONCURRENT in a single pass over both clocks."""
+        mine = self.clock
+        theirs = other.clock
+        le = ge = True  # self <= other, self >= other
+        shared = 0
+        for node, counter in mine.iteritems():
+            their_counter = theirs.get(node)
+            if their_counter is None:
+                le = False
+            else:
+                shared += 1
+                if counter < their_counter:
+                    ge = False
+                elif counter > their_counter:
+                    le = False
+            if not (le or ge):
+                return CONCURRENT
+        if shared < len(theirs):
+            # other has seen nodes that self has not
+            ge = False
+        if le:
+            return EQUAL if ge else BEFORE
+        return AFTER if ge else CONCURRENT
+
     def __eq__(self, other):
         return self.clock == other.clock
 
     def __lt__(self, other):
-        if self == other:
-            return False
-        for node in self.clock:
-            if node not in other.clock:
-                return False
-            elif self.clock[node] > other.clock[node]:
-                return False
-        return True
+        return self.compare(other) == BEFORE
 
     def __ne__(self, other):
         return not (self == other)
 
     def __le__(self, other):
-        return (self == other) or (self < other)
+        return self.compare(other) in (BEFORE, EQUAL)
 
     def __gt__(self, other):
-        return (other < self)
+        return self.compare(other) == AFTER
 
     def __ge__(self, other):
-        return (self == other) or (self > other)
+        return self.compare(other) in (AFTER, EQUAL)
 
 # PART converge
     @classmethod
@@ -96,17 +133,234 @@ class VectorClock(object):
                     result.clock[node] = counter
         return result
 
+# PART coalesce
+    @classmethod
+    def coalesce(cls, vcs):
+        """Return the input VectorClocks that no other input clock is descended
+        from, without duplicates, in the order they were given"""
+        return _coalesce(vcs, lambda vc: (sum(vc.clock.itervalues()), len(vc.clock)))
+
+def _coalesce(vcs, size):
+    """Drop every clock that is equal to or dominated by another.
+
+    size(vc) gives (sum of counters, number of nodes). A clock descended
+    from another is at least as large in both, and strictly larger in one,
+    so visiting the clocks largest first means each need only be compared
+    against the survivors found so far.
+    """
+    candidates = []
+    for i, vc in enumerate(vcs):
+        if vc is not None:
+            total, nodes = size(vc)
+            candidates.append((-total, -nodes, i, vc))
+    candidates.sort()
+    survivors = []
+    for _, _, i, vc in candidates:
+        for _, kept in survivors:
+            if vc.compare(kept) in (BEFORE, EQUAL):
+                break
+        else:
+            survivors.append((i, vc))
+    survivors.sort()
+    return [vc for _, vc in survivors]
+
+# PART compact
+# Node names are interned to small integers shared by every CompactVectorClock.
+# An index is never reused, since any clock may still hold it, so the table
+# only grows; node names come from clients, so it is capped at MAX_NODES.
+# Once it is full, a new name stands for itself in a clock instead. Such a
+# name is never interned later, so it is always represented the same way,
+# and as every index sorts before every name, clocks stay in one order.
+MAX_NODES = 1 << 20
+_node_index = {}  # node => index
+_node_names = []  # index => node
+_intern_lock = threading.Lock()
+
+def _intern(node):
+    index = _node_index.get(node)
+    if index is None:
+        with _intern_lock:
+            # Another thread may have interned node since we looked
+            index = _node_index.get(node)
+            if index is None:
+                if len(_node_names) >= MAX_NODES:
+                    return node
+                index = len(_node_names)
+                _node_names.append(node)
+                _node_index[node] = index
+    return index
+
+def _name(node):
+    """The name of an interned index, or of a node that was not interned."""
+    return _node_names[node] if isinstance(node, int) else node
+
+def _compare(anodes, acounts, bnodes, bcounts):
+    """Compare clock a with clock b in one pass, as VectorClock.compare."""
+    if anodes == bnodes:
+        # The common case: both clocks have seen the same nodes
+        le = ge = True
+        for x, y in izip(acounts, bcounts):
+            if x < y:
+                ge = False
+            elif x > y:
+                le = False
+            else:
+                continue
+            if not (le or ge):
+                return CONCURRENT
+    else:
+        le = ge = True
+        i = j = 0
+        na = len(anodes)
+        nb = len(bnodes)
+        while i < na and j < nb:
+            if anodes[i] == bnodes[j]:
+                if acounts[i] < bcounts[j]:
+                    ge = False
+                elif acounts[i] > bcounts[j]:
+                    le = False
+                i += 1
+                j += 1
+            elif anodes[i] < bnodes[j]:
+                le = False
+                i += 1
+            else:
+                ge = False
+                j += 1
+        if i < na:
+            le = False
+        if j < nb:
+            ge = False
+    if le:
+        return EQUAL if ge else BEFORE
+    return AFTER if ge else CONCURRENT
+
+class CompactVectorClock(object):
+    """VectorClock with the same interface, stored as a tuple of interned
+    node indices in ascending order and a parallel tuple of counters.
+
+    compare() and the comparison operators walk the two clocks in step
+    without building any intermediate dicts. The clock attribute is computed on demand;
+    changing the dict it returns does not change the clock.
+    """
+    __slots__ = ('nodes', 'counts')
+
+    def __init__(self):
+        self.nodes = ()
+        self.counts = ()
+
+    def update(self, node, counter):
+        """Add a new node:counter value to a VectorClock."""
+        if counter < 0:
+            raise Exception("Node %s assigned negative count %d" % (node, counter))
+        index = _intern(node)
+        clock = dict(izip(self.nodes, self.counts))
+        if index in clock and counter <= clock[index]:
+            raise Exception("Node %s has gone backwards from %d to %d" %
+                            (node, clock[index], counter))
+        clock[index] = counter
+        self._set(clock.items())
+        return self  # allow chaining of .update() operations
+
+    def _set(self, pairs):
+        if pairs:
+            self.nodes, self.counts = zip(*sorted(pairs))
+        else:
+            self.nodes, self.counts = (), ()
+
+    @classmethod
+    def fromDict(cls, dct):
+        """ Create a CompactVectorClock from a dictionary. """
+        vc = cls()
+        if dct:
+            index = _node_index
+            try:
+                pairs = [(index[node], count) for node, count in dct.iteritems()]
+            except KeyError:
+                pairs = [(_intern(node), count) for node, count in dct.iteritems()]
+            vc._set(pairs)
+            if min(vc.counts) < 0:
+                raise Exception("Node assigned negative count %d" % min(vc.counts))
+        return vc
+
+    def asDict(self):
+        return dict([(_name(node), counter) for node, counter in izip(self.nodes, self.counts)])
+
+    @property
+    def clock(self):
+        return self.asDict()
+
+    def isValidClock(self):
+        """ Return True if this is a valid clock. """
+        for node, count in izip(self.nodes, self.counts):
+            if not isinstance(_name(node), (str, unicode)) or not isinstance(count, int) or count < 0:
+                return False
+        return True
+
+    def __str__(self):
+        return "{%s}" % ", ".join(["%s:%d" % pair for pair in self._named()])
+
+    def __repr__(self):
+        """ Represent the clock in JSON style, with the keys in double quotes. """
+        return "{%s}" % ", ".join(["\"%s\":%d" % pair for pair in self._named()])
+
+    def _named(self):
+        return sorted([(_name(node), counter) for node, counter in izip(self.nodes, self.counts)])
+
+    def compare(self, other):
+        """Return BEFORE, AFTER, EQUAL or CONCURRENT in a single pass over both clocks."""
+        return _compare(self.nodes, self.counts, other.nodes, other.counts)
+
+    def __eq__(self, other):
+        return self.counts == other.counts and self.nodes == other.nodes
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __lt__(self, other):
+        return self.compare(other) == BEFORE
+
+    def __le__(self, other):
+        return self.compare(other) in (BEFORE, EQUAL)
+
+    def __gt__(self, other):
+        return self.compare(other) == AFTER
+
+    def __ge__(self, other):
+        return self.compare(other) in (AFTER, EQUAL)
+
+    @classmethod
+    def converge(cls, vcs):
+        """Return a single CompactVectorClock that subsumes all of the input clocks"""
+        clock = {}
+        for vc in vcs:
+            if vc is None:
+                continue
+            for node, counter in izip(vc.nodes, vc.counts):
+                if clock.get(node, -1) < counter:
+                    clock[node] = counter
+        result = cls()
+        result._set(clock.items())
+        return result
+
+    @classmethod
+    def coalesce(cls, vcs):
+        """Return the input clocks that no other input clock is descended
+        from, without duplicates, in the order they were given"""
+        return _coalesce(vcs, lambda vc: (sum(vc.counts), len(vc.counts)))
+
 # -----------IGNOREBEYOND: test code ---------------
 import unittest
 
 
 class VectorClockTestCase(unittest.TestCase):
     """Test vector clock class"""
+    clock_class = VectorClock
 
     def setUp(self):
-        self.c1 = VectorClock()
+        self.c1 = self.clock_class()
         self.c1.update('A', 1)
-        self.c2 = VectorClock()
+        self.c2 = self.clock_class()
         self.c2.update('B', 2)
 
     def testSmall(self):
@@ -144,17 +398,38 @@ class VectorClockTestCase(unittest.TestCase):
         self.assertEquals(self.c1 >= self.c2, True)
         self.assertEquals(self.c2 >= self.c1, False)
 
+    def testCompare(self):
+        self.assertEquals(self.c1.compare(self.c2), CONCURRENT)
+        self.assertEquals(self.c1.compare(self.c1), EQUAL)
+        self.c1.update('B', 2)
+        self.assertEquals(self.c1.compare(self.c2), AFTER)
+        self.assertEquals(self.c2.compare(self.c1), BEFORE)
+        self.c2.update('B', 3)
+        self.assertEquals(self.c1.compare(self.c2), CONCURRENT)
+        self.c2.update('A', 1)
+        self.assertEquals(self.c1.compare(self.c2), BEFORE)
+        self.assertEquals(self.c2.compare(self.c1), AFTER)
+        c3 = self.clock_class().update('A', 0)
+        self.assertEquals(c3.compare(self.clock_class()), AFTER)
+        self.assertEquals(self.clock_class().compare(c3), BEFORE)
+
     def testCoalesce(self):
         self.c1.update('B', 2)
-        self.assertEquals(VectorClock.coalesce((self.c1, self.c1, self.c1)), [self.c1])
+        self.assertEquals(self.clock_class.coalesce((self.c1, self.c1, self.c1)), [self.c1])
         c3 = copy.deepcopy(self.c1)
         c4 = copy.deepcopy(self.c1)
         # Diverge the two clocks
         c3.update('X', 200)
         c4.update('Y', 100)
         # c1 < c3, c1 < c4
-        self.assertEquals(VectorClock.coalesce(((self.c1, c3, c4))), [c3, c4])
-        self.assertEquals(VectorClock.coalesce((c3, self.c1, c3, c4)), [c3, c4])
+        self.assertEquals(self.clock_class.coalesce(((self.c1, c3, c4))), [c3, c4])
+        self.assertEquals(self.clock_class.coalesce((c3, self.c1, c3, c4)), [c3, c4])
+
+    def testCoalesceConcurrent(self):
+        c3 = self.clock_class().update('A', 1).update('B', 1)
+        c4 = self.clock_class().update('A', 5)
+        self.assertEquals(self.clock_class.coalesce((self.c2, self.c1, c3, None, c4, c3)), [self.c2, c3, c4])
+        self.assertEquals(self.clock_class.coalesce(()), [])
 
     def testConverge(self):
         self.c1.update('B', 1)
@@ -163,11 +438,74 @@ class VectorClockTestCase(unittest.TestCase):
         # Diverge two of the clocks
         c3.update('X', 200)
         self.c1.update('Y', 100)
-        cx = VectorClock.converge((self.c1, self.c2, c3, c4))
+        cx = self.clock_class.converge((self.c1, self.c2, c3, c4))
         self.assertEquals(str(cx), "{A:1, B:2, X:200, Y:100}")
-        cy = VectorClock.converge(VectorClock.coalesce((self.c1, self.c2, c3, c4)))
+        cy = self.clock_class.converge(self.clock_class.coalesce((self.c1, self.c2, c3, c4)))
         self.assertEquals(str(cy), "{A:1, B:2, X:200, Y:100}")
 
 
+    def testValidClockDict(self):
+        self.assertTrue(isValidClockDict({}))
+        self.assertTrue(isValidClockDict({'A': 0, u'B': 5}))
+        self.assertFalse(isValidClockDict(None))
+        self.assertFalse(isValidClockDict([['A', 1]]))
+        self.assertFalse(isValidClockDict({'A': '5'}))
+        self.assertFalse(isValidClockDict({'A': 1.5}))
+        self.assertFalse(isValidClockDict({'A': True}))
+        self.assertFalse(isValidClockDict({'A': -1}))
+
+    def testDictRoundTrip(self):
+        self.c1.update('B', 3)
+        vc = self.clock_class.fromDict(self.c1.asDict())
+        self.assertEquals(vc, self.c1)
+        self.assertEquals(vc.asDict(), {'A': 1, 'B': 3})
+        self.assertEquals(vc.clock, {'A': 1, 'B': 3})
+        self.assertRaises(Exception, self.clock_class.fromDict, {'A': -1})
+
+
+class CompactVectorClockTestCase(VectorClockTestCase):
+    """Run the vector clock tests against the compact representation"""
+    clock_class = CompactVectorClock
+
+    def testSlots(self):
+        self.assertRaises(AttributeError, setattr, self.c1, 'extra', 1)
+
+    def testRepr(self):
+        self.c1.update('B', 2)
+        self.assertEquals(repr(self.c1), '{"A":1, "B":2}')
+        self.assertEquals(repr(self.c1), repr(VectorClock.fromDict(self.c1.asDict())))
+
+    def testInternThreads(self):
+        names = ['T%d' % i for i in range(200)]
+        def intern_all():
+            for name in names:
+                _intern(name)
+        threads = [threading.Thread(target=intern_all) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for name in names:
+            self.assertEquals(_node_names[_node_index[name]], name)
+        self.assertEquals(len(_node_names), len(set(_node_names)))
+
+    def testInternLimit(self):
+        global MAX_NODES
+        saved = MAX_NODES
+        MAX_NODES = len(_node_names)
+        try:
+            self.assertEquals(self.clock_class.fromDict({'A': 3}).asDict(), {'A': 3})
+            vc = self.clock_class.fromDict({'A': 3, 'never-seen': 1})
+            self.assertEquals(vc.asDict(), {'A': 3, 'never-seen': 1})
+            self.assertEquals(str(vc), "{A:3, never-seen:1}")
+            self.assertTrue(vc.isValidClock())
+            self.assertEquals(vc.compare(self.clock_class.fromDict({'A': 3})), AFTER)
+            self.assertEquals(vc.compare(self.clock_class().update('never-seen', 2)), CONCURRENT)
+            self.assertEquals(vc, self.clock_class.fromDict({'never-seen': 1}).update('A', 3))
+            self.assertNotIn('never-seen', _node_index)
+        finally:
+            MAX_NODES = saved
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,138 @@
+# CMPT 474 Spring 2014, Assignment 6
+# HTTP/1.1 keep-alive WSGI server for bottle, built on wsgiref
+
+# Core libraries
+import os
+import socket
+import signal
+import threading
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+# Libraries that have to have been installed by pip
+from bottle import ServerAdapter
+
+# Seconds an idle keep-alive connection is held open before it is dropped
+IDLE_TIMEOUT = 30
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        # Without a length the client can only find the end of the body
+        # by the connection closing
+        if 'Content-Length' not in self.headers:
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = 1
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """ Serve any number of requests over one connection.
+
+        The standard wsgiref handler answers a single HTTP/1.0 request and
+        then closes the socket, so every client call pays for a new TCP
+        connection. Each request body is read in full before the app runs,
+        so a handler that ignores the body cannot desynchronise the stream.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+
+    def handle(self):
+        self.close_connection = 0
+        while not self.close_connection:
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            except socket.timeout:
+                return
+            if not self.raw_requestline:
+                return
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+            if not self.parse_request(): # An error code has been sent, just exit
+                return
+
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                # Let the app read the chunked body, then give up on the connection
+                body = self.rfile
+                self.close_connection = 1
+            else:
+                body = StringIO(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+            handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(), self.get_environ())
+            handler.request_handler = self      # backpointer for logging
+            handler.run(self.server.get_app())
+            self.wfile.flush()
+
+    def address_string(self):
+        # Prevent reverse DNS lookups
+        return self.client_address[0]
+
+    def log_request(self, *args, **kw):
+        pass
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ Handle each connection in its own thread. """
+    daemon_threads = True
+
+def serialized(app):
+    """ Wrap app so that only one request runs it at a time. """
+    lock = threading.Lock()
+    def wrapped(environ, start_response):
+        with lock:
+            return list(app(environ, start_response))
+    return wrapped
+
+def prefork(workers):
+    """ Fork workers-1 children. Returns the list of their pids in the
+        parent and None in each child.
+
+        The parent terminates its children when it is itself terminated.
+    """
+    children = []
+    for i in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            return None
+        children.append(pid)
+    if children:
+        def terminate(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            # Exit at once, as the default handler would, rather than
+            # unwinding under the connection threads
+            os._exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+    return children
+
+class KeepAliveServer(ServerAdapter):
+    """ bottle server adapter: run(server=KeepAliveServer, ...)
+
+        Each connection gets its own thread so an idle keep-alive client
+        cannot starve the others. Unless the 'serialize=False' option is
+        given, requests still execute one at a time, exactly as they do
+        under the default single-threaded server.
+
+        With the 'workers=N' option, N processes accept connections on the
+        one listening socket, so the server can use N cores. Each calls
+        the 'on_start' option, if given, before serving; threads started
+        before the fork run in the parent only.
+    """
+    def run(self, app):
+        if self.options.get('serialize', True):
+            app = serialized(app)
+        self.srv = ThreadingWSGIServer((self.host, self.port), KeepAliveHandler)
+        self.srv.set_app(app)
+        prefork(self.options.get('workers', 1))
+        on_start = self.options.get('on_start')
+        if on_start is not None:
+            on_start()
+        self.srv.serve_forever()